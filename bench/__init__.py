@@ -0,0 +1 @@
+"""Offline benchmark harness for the bot (run with `python -m bench --help`)."""
@@ -0,0 +1,123 @@
+"""
+Offline load test: python -m bench [--scenario downloads --users 100 ...]
+
+Starts a fake Bot API on localhost, imports the bot with a stub downloader and
+feeds it virtual-user updates. Prints throughput, handler latency percentiles,
+queue wait and event-loop lag; --json writes the same data to a file and
+--budget makes the run fail when a metric is over its limit (for CI).
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import os
+import sys
+import tempfile
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PACKAGE_DIR)
+
+from bench.fake_api import FakeBotAPI
+from bench.report import check_budgets, format_report
+from bench.scenarios import SCENARIOS, BenchContext
+from bench.stub import StubDownloader
+
+MB = 1024 * 1024
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog="python -m bench", description="Offline load test of the bot")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="default: all scenarios")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--iterations", type=int, default=3, help="links sent by every virtual user")
+    parser.add_argument("--video-ratio", type=float, default=0.7)
+    parser.add_argument("--repeat-ratio", type=float, default=0.2, help="share of links to popular media")
+    parser.add_argument("--think-time", type=float, default=0.5, help="mean seconds before picking a format")
+    parser.add_argument("--recipients", type=int, default=500, help="broadcast recipients")
+    parser.add_argument("--video-mb", type=float, default=8)
+    parser.add_argument("--audio-mb", type=float, default=3)
+    parser.add_argument("--download-mbps", type=float, default=20, help="stub download speed, MB/s")
+    parser.add_argument("--probe-latency", type=float, default=0.3)
+    parser.add_argument("--api-latency", type=float, default=0.05)
+    parser.add_argument("--api-jitter", type=float, default=0.02)
+    parser.add_argument("--upload-mbps", type=float, default=None, help="fake Bot API upload speed, MB/s")
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.0, help="share of API calls answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--budget", action="append", default=[], metavar="METRIC.STAT=MS",
+                        help="fail if e.g. handle_url.p95=250 or loop_lag.max=100 is exceeded")
+    return parser.parse_args()
+
+
+async def run(args):
+    api = FakeBotAPI(
+        latency=args.api_latency,
+        jitter=args.api_jitter,
+        rate_limit_ratio=args.rate_limit_ratio,
+        retry_after=args.retry_after,
+        upload_bandwidth=args.upload_mbps * MB if args.upload_mbps else None,
+        seed=args.seed,
+    )
+    await api.start()
+
+    # Бот пишет базу, кэш и файлы в текущую папку — запускаем его во временной
+    workdir = tempfile.mkdtemp(prefix="gld-bench-")
+    os.chdir(workdir)
+    os.environ.update({
+        "BOT_TOKEN": "123456:BENCH",
+        "TELEGRAM_API_URL": api.url,
+        "STATS_DB": os.path.join(workdir, "user_stats.db"),
+        "ROLE": "all",
+        "STATE_URL": "memory://",
+    })
+    app = importlib.import_module("main")
+    logging.getLogger().setLevel(logging.WARNING)
+
+    stub = StubDownloader(
+        os.path.join(workdir, "downloads"),
+        video_size=int(args.video_mb * MB),
+        audio_size=int(args.audio_mb * MB),
+        bandwidth=args.download_mbps * MB,
+        probe_latency=args.probe_latency,
+    )
+    app.downloader = stub
+
+    ctx = BenchContext(app, api, stub, seed=args.seed)
+    results = {"scenarios": []}
+    await app.dp.emit_startup(bot=app.bot, dispatcher=app.dp)
+    try:
+        for name in args.scenario or list(SCENARIOS):
+            if name == "downloads":
+                result = await SCENARIOS[name](
+                    ctx, users=args.users, iterations=args.iterations, video_ratio=args.video_ratio,
+                    repeat_ratio=args.repeat_ratio, think_time=args.think_time,
+                )
+            else:
+                result = await SCENARIOS[name](ctx, recipients=args.recipients)
+            results["scenarios"].append(result)
+    finally:
+        await app.dp.emit_shutdown(bot=app.bot, dispatcher=app.dp)
+        await app.bot.session.close()
+        await api.stop()
+    results["api"] = api.summary()
+    return results
+
+
+def main():
+    args = parse_args()
+    results = asyncio.run(run(args))
+    print(format_report(results))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    violations = check_budgets(results, args.budget)
+    for violation in violations:
+        print(f"BUDGET EXCEEDED: {violation}", file=sys.stderr)
+    sys.exit(1 if violations else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import asyncio
+import itertools
+import random
+import time
+from collections import Counter
+
+from aiohttp import web
+
+
+class FakeBotAPI:
+    """
+    Local stand-in for the Telegram Bot API.
+    Every call waits `latency` seconds (± `jitter`), uploads additionally take
+    size / `upload_bandwidth` seconds, and a `rate_limit_ratio` share of calls
+    is answered with 429 and `retry_after`.
+    """
+
+    def __init__(self, latency=0.05, jitter=0.02, rate_limit_ratio=0.0, retry_after=1,
+                 upload_bandwidth=None, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.upload_bandwidth = upload_bandwidth
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.rate_limited = Counter()
+        self.uploaded_bytes = 0
+        self._message_ids = itertools.count(1_000_000)
+        self._file_ids = itertools.count(1)
+        self._runner = None
+        self.url = None
+
+    async def start(self, host="127.0.0.1", port=0):
+        # Загрузки файлов приходят одним multipart-запросом, поэтому снимаем лимит размера тела
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        form = await request.post()
+        self.calls[method] += 1
+
+        delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+        upload = sum(len(field.file.read()) for field in form.values() if isinstance(field, web.FileField))
+        self.uploaded_bytes += upload
+        if upload and self.upload_bandwidth:
+            delay += upload / self.upload_bandwidth
+        await asyncio.sleep(delay)
+
+        if self.rate_limit_ratio and self.random.random() < self.rate_limit_ratio:
+            self.rate_limited[method] += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            })
+        return web.json_response({"ok": True, "result": self._result(method, form)})
+
+    def _message(self, form, **extra):
+        chat_id = int(form.get("chat_id", 0))
+        message_id = int(form["message_id"]) if "message_id" in form else next(self._message_ids)
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            **extra,
+        }
+
+    def _file(self, **extra):
+        n = next(self._file_ids)
+        return {"file_id": f"bench-file-{n}", "file_unique_id": f"bench-{n}", **extra}
+
+    def _result(self, method, form):
+        lower = method.lower()
+        if lower == "getme":
+            return {"id": 123456, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        if lower == "getchatmember":
+            user_id = int(form.get("user_id", 0))
+            return {"status": "member", "user": {"id": user_id, "is_bot": False, "first_name": "user"}}
+        if lower in ("sendmessage", "editmessagetext"):
+            return self._message(form, text=form.get("text", ""))
+        if lower == "sendvideo":
+            return self._message(form, video=self._file(width=1280, height=720, duration=60))
+        if lower == "sendaudio":
+            return self._message(form, audio=self._file(duration=180))
+        if lower == "copymessage":
+            return {"message_id": next(self._message_ids)}
+        return True
+
+    def delivered(self):
+        """Number of media files accepted (not answered with 429)."""
+        return sum(self.calls[m] - self.rate_limited[m] for m in ("sendVideo", "sendAudio"))
+
+    def summary(self):
+        return {
+            "calls": dict(self.calls),
+            "rate_limited": dict(self.rate_limited),
+            "uploaded_mb": round(self.uploaded_bytes / 1024 / 1024, 1),
+        }
@@ -0,0 +1,105 @@
+import asyncio
+import math
+import time
+from collections import defaultdict
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a list of numbers (None for an empty list)."""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(1, math.ceil(p / 100 * len(values)))
+    return values[rank - 1]
+
+
+class Recorder:
+    """Collects latency samples (seconds) and counters by name."""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.counters = defaultdict(int)
+
+    def add(self, name, seconds):
+        self.samples[name].append(seconds)
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def summary(self):
+        result = {}
+        for name, values in sorted(self.samples.items()):
+            result[name] = {
+                "count": len(values),
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "p99": percentile(values, 99),
+                "max": max(values),
+            }
+        return result
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up a task that sleeps `interval` seconds."""
+
+    def __init__(self, recorder, name="loop_lag", interval=0.05):
+        self.recorder = recorder
+        self.name = name
+        self.interval = interval
+        self._task = None
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.recorder.add(self.name, max(0.0, time.perf_counter() - started - self.interval))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+def _ms(value):
+    return "-" if value is None else f"{value * 1000:.1f}"
+
+
+def format_report(results):
+    lines = []
+    for scenario in results["scenarios"]:
+        lines.append(f"== {scenario['name']} ({scenario['wall_time']:.2f}s)")
+        for key, value in scenario["totals"].items():
+            lines.append(f"  {key}: {value}")
+        lines.append(f"  {'metric':<20} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+        for name, s in scenario["latency"].items():
+            lines.append(
+                f"  {name:<20} {s['count']:>7} {_ms(s['p50']):>9} {_ms(s['p95']):>9} {_ms(s['p99']):>9} {_ms(s['max']):>9}"
+            )
+    api = results["api"]
+    lines.append("== Bot API")
+    lines.append(f"  uploaded: {api['uploaded_mb']} MB")
+    for method, n in sorted(api["calls"].items()):
+        limited = api["rate_limited"].get(method, 0)
+        lines.append(f"  {method:<22} {n:>7}" + (f"  (429: {limited})" if limited else ""))
+    return "\n".join(lines)
+
+
+def check_budgets(results, budgets):
+    """
+    Budgets look like "handle_url.p95=250" (milliseconds); returns the list of violations.
+    A metric is checked in every scenario that reports it.
+    """
+    violations = []
+    for budget in budgets:
+        metric, limit = budget.split("=")
+        name, stat = metric.rsplit(".", 1)
+        for scenario in results["scenarios"]:
+            value = scenario["latency"].get(name, {}).get(stat)
+            if value is not None and value * 1000 > float(limit):
+                violations.append(f"{scenario['name']}: {metric} = {value * 1000:.1f} ms > {limit} ms")
+    return violations
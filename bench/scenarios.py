@@ -0,0 +1,140 @@
+import asyncio
+import itertools
+import random
+import time
+
+from aiogram import types
+
+from bench.report import LoopLagMonitor, Recorder
+
+
+class BenchContext:
+    """
+    Feeds synthetic updates into the bot's dispatcher the same way polling/webhook do
+    and times every handler.
+    """
+
+    def __init__(self, app, api, stub, seed=None):
+        self.app = app  # импортированный модуль main
+        self.api = api
+        self.stub = stub
+        self.random = random.Random(seed)
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def _user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"}
+
+    def _message(self, user_id, text, message_id=None):
+        return {
+            "message_id": message_id or next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            "text": text,
+        }
+
+    async def feed(self, recorder, name, update):
+        started = time.perf_counter()
+        try:
+            await self.app.dp.feed_update(self.app.bot, types.Update.model_validate(update))
+        except Exception as e:
+            recorder.count(f"errors.{name}")
+            recorder.count(f"errors.{type(e).__name__}")
+        recorder.add(name, time.perf_counter() - started)
+
+    async def message(self, recorder, name, user_id, text):
+        message = self._message(user_id, text)
+        await self.feed(recorder, name, {"update_id": next(self._update_ids), "message": message})
+        return message["message_id"]
+
+    async def callback(self, recorder, name, user_id, data):
+        await self.feed(recorder, name, {
+            "update_id": next(self._update_ids),
+            "callback_query": {
+                "id": str(next(self._update_ids)),
+                "from": self._user(user_id),
+                "chat_instance": str(user_id),
+                "message": self._message(user_id, "menu"),
+                "data": data,
+            },
+        })
+
+
+async def _measure(ctx, name, body):
+    recorder = Recorder()
+    lag = LoopLagMonitor(recorder)
+    delivered_before = ctx.api.delivered()
+    lag.start()
+    started = time.perf_counter()
+    totals = await body(recorder)
+    wall_time = time.perf_counter() - started
+    await lag.stop()
+    delivered = ctx.api.delivered() - delivered_before
+    totals = {
+        "delivered_files": delivered,
+        "files_per_second": round(delivered / wall_time, 2),
+        **totals,
+        **recorder.counters,
+    }
+    return {"name": name, "wall_time": wall_time, "totals": totals, "latency": recorder.summary()}
+
+
+async def downloads(ctx, users=50, iterations=3, video_ratio=0.7, repeat_ratio=0.2, think_time=0.5):
+    """
+    Virtual users open the bot, send a link, pick a format after `think_time` seconds
+    and wait for the file. `repeat_ratio` of the links are popular ones shared by
+    everybody, which exercises the file_id cache and job coalescing.
+    """
+    popular = [f"https://example.com/popular/{i}" for i in range(5)]
+
+    async def virtual_user(recorder, user_id):
+        await ctx.message(recorder, "start", user_id, "/start")
+        for i in range(iterations):
+            if ctx.random.random() < repeat_ratio:
+                url = ctx.random.choice(popular)
+            else:
+                url = f"https://example.com/{user_id}/{i}"
+            mode = "video" if ctx.random.random() < video_ratio else "audio"
+
+            message_id = await ctx.message(recorder, "handle_url", user_id, url)
+            await asyncio.sleep(ctx.random.uniform(0, 2 * think_time))
+            clicked = time.monotonic()
+            await ctx.callback(recorder, "process_download", user_id, f"dl_{mode}_{message_id}")
+            started = ctx.stub.started.pop((url, mode), None)
+            if started is not None and started >= clicked:
+                recorder.add("queue_wait", started - clicked)
+
+    async def body(recorder):
+        await asyncio.gather(*(virtual_user(recorder, 10_000 + n) for n in range(users)))
+        return {"users": users, "link_requests": users * iterations}
+
+    return await _measure(ctx, "downloads", body)
+
+
+async def broadcast(ctx, recipients=500):
+    """The admin sends a broadcast to `recipients` users; measures delivery rate and handler latency."""
+    app = ctx.app
+    today = app.datetime.now().date().isoformat()
+    for n in range(recipients):
+        app.stats_store.touch_user(str(1_000_000 + n), None, today)
+    app.stats_store.commit()
+
+    async def body(recorder):
+        sent_before = ctx.api.calls["copyMessage"]
+        await ctx.callback(recorder, "start_broadcast", app.ADMIN_ID, "admin_broadcast")
+        await ctx.message(recorder, "perform_broadcast", app.ADMIN_ID, "Benchmark broadcast")
+        started = time.perf_counter()
+        while app.stats_store.unfinished_broadcasts():
+            await asyncio.sleep(0.1)
+        elapsed = time.perf_counter() - started
+        sent = ctx.api.calls["copyMessage"] - sent_before
+        return {"recipients": app.stats_store.count_reachable(), "messages_per_second": round(sent / elapsed, 1)}
+
+    return await _measure(ctx, "broadcast", body)
+
+
+SCENARIOS = {
+    "downloads": downloads,
+    "broadcast": broadcast,
+}
@@ -0,0 +1,78 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+
+
+class StubDownloader:
+    """
+    Drop-in replacement for `downloader.Downloader` that never touches the network.
+    Probing takes `probe_latency` seconds, a download takes size / `bandwidth` seconds
+    and produces a synthetic file of `video_size` or `audio_size` bytes.
+    The start time of every download is recorded to measure queue wait.
+    """
+
+    def __init__(self, download_path, video_size=8 * 1024 * 1024, audio_size=3 * 1024 * 1024,
+                 bandwidth=20 * 1024 * 1024, probe_latency=0.3, max_bytes=50 * 1024 * 1024):
+        self.download_path = download_path
+        self.sizes = {"video": video_size, "audio": audio_size}
+        self.bandwidth = bandwidth
+        self.probe_latency = probe_latency
+        self.max_bytes = max_bytes
+        self.started = {}
+        self.downloads = 0
+        os.makedirs(download_path, exist_ok=True)
+
+    def media_key(self, url, mode):
+        return f"stub:{url}:{mode}"
+
+    def cached_info(self, url):
+        return None
+
+    async def probe(self, url):
+        await asyncio.sleep(self.probe_latency)
+        duration = 180
+        return {
+            "title": f"Synthetic media for {url}",
+            "duration": duration,
+            "filesize": self.sizes["video"],
+            "formats": [
+                {"format_id": "140", "ext": "m4a", "vcodec": "none", "acodec": "mp4a.40.2",
+                 "abr": 128, "filesize": self.sizes["audio"]},
+            ],
+        }
+
+    async def download(self, url, mode="video", on_progress=None):
+        self.started[(url, mode)] = time.monotonic()
+        if on_progress:
+            on_progress({"stage": "extract"})
+        size = self.sizes[mode]
+        await asyncio.sleep(size / self.bandwidth)
+        if on_progress:
+            on_progress({"stage": "download", "downloaded": size, "total": size, "speed": self.bandwidth, "eta": 0})
+        job_dir = tempfile.mkdtemp(dir=self.download_path)
+        path = os.path.join(job_dir, "media.mp4" if mode == "video" else "media.m4a")
+        await asyncio.to_thread(self._write, path, size)
+        self.downloads += 1
+        return path
+
+    @staticmethod
+    def _write(path, size):
+        chunk = b"\0" * (1024 * 1024)
+        with open(path, "wb") as f:
+            for offset in range(0, size, len(chunk)):
+                f.write(chunk[:size - offset])
+
+    def cleanup(self, file_path):
+        if file_path:
+            shutil.rmtree(os.path.dirname(file_path), ignore_errors=True)
+
+    def start(self):
+        pass
+
+    async def warm_up(self):
+        pass
+
+    async def close(self):
+        pass
@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import time
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+from metrics import BROADCAST_MESSAGES
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Token bucket limiting the global send rate.
+    `pause` blocks all senders, e.g. when Telegram answers with retry_after.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class BroadcastEngine:
+    """
+    Sends a message to all users in the background.
+    Each recipient gets exactly one message, so Telegram's per-chat limit (1 msg/s)
+    is never hit and only the global limit (~30 msg/s) is enforced by the token bucket.
+    Progress is checkpointed to the store after every chunk, so an interrupted
+    broadcast resumes after a restart (at most one chunk is sent again).
+    """
+
+    def __init__(self, bot, store, rate=25, workers=10, chunk_size=200, max_retries=5):
+        self.bot = bot
+        self.store = store
+        self.bucket = TokenBucket(rate)
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+        self._tasks = {}
+
+    def start(self, admin_chat_id, from_chat_id, message_id, status_message_id):
+        total = self.store.count_reachable()
+        broadcast_id = self.store.create_broadcast(admin_chat_id, from_chat_id, message_id, status_message_id, total)
+        self._spawn(broadcast_id)
+        return broadcast_id
+
+    def resume(self):
+        for broadcast_id in self.store.unfinished_broadcasts():
+            logger.info(f"Resuming broadcast {broadcast_id}")
+            self._spawn(broadcast_id)
+
+    async def stop(self):
+        for task in self._tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    def _spawn(self, broadcast_id):
+        if broadcast_id in self._tasks:
+            return
+        task = asyncio.create_task(self._run(broadcast_id))
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda t: self._tasks.pop(broadcast_id, None))
+
+    async def _run(self, broadcast_id):
+        job = self.store.get_broadcast(broadcast_id)
+        counters = {"sent": job["sent"], "failed": job["failed"], "blocked": job["blocked"]}
+        cursor = job["cursor"]
+        semaphore = asyncio.Semaphore(self.workers)
+
+        async def send(user_id):
+            async with semaphore:
+                result = await self._send_one(user_id, job["from_chat_id"], job["message_id"])
+            counters[result] += 1
+            BROADCAST_MESSAGES.inc(result=result)
+            if result == "blocked":
+                self.store.mark_blocked(user_id)
+
+        try:
+            while True:
+                batch = self.store.broadcast_recipients(cursor, self.chunk_size)
+                if not batch:
+                    break
+                await asyncio.gather(*(send(user_id) for _, user_id in batch))
+                cursor = batch[-1][0]
+                self.store.checkpoint_broadcast(broadcast_id, cursor, **counters)
+                await self._report(job, counters, finished=False)
+        except Exception as e:
+            logger.error(f"Broadcast {broadcast_id} interrupted: {e}", exc_info=True)
+            return
+
+        self.store.checkpoint_broadcast(broadcast_id, cursor, done=True, **counters)
+        await self._report(job, counters, finished=True)
+
+    async def _send_one(self, user_id, from_chat_id, message_id):
+        for _ in range(self.max_retries):
+            await self.bucket.acquire()
+            try:
+                await self.bot.copy_message(chat_id=user_id, from_chat_id=from_chat_id, message_id=message_id)
+                return "sent"
+            except TelegramRetryAfter as e:
+                logger.warning(f"Flood control during broadcast, sleeping {e.retry_after}s")
+                self.bucket.pause(e.retry_after)
+            except TelegramForbiddenError:
+                return "blocked"
+            except TelegramBadRequest as e:
+                if "chat not found" in str(e).lower():
+                    return "blocked"
+                logger.error(f"Failed to send message to {user_id}: {e}")
+                return "failed"
+            except Exception as e:
+                logger.error(f"Failed to send message to {user_id}: {e}")
+                return "failed"
+        return "failed"
+
+    async def _report(self, job, counters, finished):
+        done = counters["sent"] + counters["failed"] + counters["blocked"]
+        if finished:
+            text = (f"✅ Рассылка завершена! Получили: {counters['sent']}/{job['total']}\n"
+                    f"🚫 Заблокировали бота: {counters['blocked']} | ⚠️ Ошибок: {counters['failed']}")
+        else:
+            text = (f"🚀 Рассылка идёт: {done}/{job['total']}\n"
+                    f"✅ {counters['sent']} | 🚫 {counters['blocked']} | ⚠️ {counters['failed']}")
+        try:
+            if finished or not job["status_message_id"]:
+                await self.bot.send_message(job["admin_chat_id"], text)
+            else:
+                await self.bot.edit_message_text(text, chat_id=job["admin_chat_id"], message_id=job["status_message_id"])
+        except Exception as e:
+            logger.warning(f"Failed to report broadcast progress: {e}")
@@ -1,36 +1,647 @@
-import yt_dlp
+# yt_dlp импортируется при первом использовании: импорт с реестром экстракторов занимает секунды,
+# а основному процессу он нужен только для media_key (см. Downloader.warm_up)
 import os
+import json
+import mmap
+import time
+import shutil
+import struct
+import tempfile
+import functools
 import asyncio
 import logging
+from collections import OrderedDict
+from workers import WorkerPool, report_progress
+from janitor import DiskJanitor, process_root
+from resolver import ResolverCache, TrackResolver
+from metrics import REGISTRY, STAGE_SECONDS, DOWNLOADS, BYTES, WORKERS_BUSY
 
 logger = logging.getLogger(__name__)
 
+MUSIC_PLATFORMS = ["spotify.com", "music.yandex", "yandex.ru/music"]
+
+
+def is_music_url(url):
+    """Spotify / Yandex Music links: resolved to YouTube and always downloaded as audio."""
+    return any(platform in url for platform in MUSIC_PLATFORMS)
+
+# Долгоживущие экземпляры YoutubeDL в процессе-воркере, по одному на набор опций
+_ydl_profiles = {}
+
+# Состояние текущей задачи в процессе-воркере (воркер выполняет задачи по одной)
+_job_state = {'mode': None, 'budget': None, 'bytes': {}, 'expected': {}}
+
+
+class _SizeLimitExceeded(Exception):
+    pass
+
+
+def _size_guard(d):
+    """
+    Progress hook that aborts the download once it grows past the job's byte budget,
+    or right away when the sizes announced by the server (Content-Length) don't fit.
+    In audio mode a stream that carries video isn't checked: only its audio is kept,
+    and plan_format has already checked the audio's estimated size.
+    """
+    if d.get('status') != 'downloading':
+        return
+    filename = d.get('filename')
+    downloaded = d.get('downloaded_bytes') or 0
+    _job_state['bytes'][filename] = downloaded
+    # total_bytes_estimate у фрагментных загрузок слишком неточен, учитываем только точный размер
+    _job_state['expected'][filename] = max(downloaded, d.get('total_bytes') or 0)
+    budget = _job_state['budget']
+    if not budget:
+        return
+    if _job_state['mode'] == 'audio' and _codec((d.get('info_dict') or {}).get('vcodec')) not in ('', 'none'):
+        return
+    total = sum(_job_state['expected'].values())
+    if total > budget:
+        raise _SizeLimitExceeded(total)
+
+
+_RATE = struct.Struct('d')
+# Открытые в процессе-воркере файлы с долей общей полосы: путь -> mmap
+_share_maps = {}
+
+
+def _shared_rate(path):
+    share = _share_maps.get(path)
+    if share is None:
+        with open(path, 'rb') as f:
+            share = _share_maps[path] = mmap.mmap(f.fileno(), _RATE.size, access=mmap.ACCESS_READ)
+    return _RATE.unpack(share[:_RATE.size])[0]
+
+
+def _bandwidth_guard(d):
+    """
+    Progress hook that throttles the whole job (all files and fragments together)
+    to the profile's rate cap and to its current share of the global ceiling.
+    Unlike yt-dlp's own `ratelimit`, this also holds with concurrent fragment downloads.
+    """
+    limits = _job_state['bandwidth']
+    if not limits or d.get('status') != 'downloading':
+        return
+    rate = limits.get('rate')
+    if limits.get('share'):
+        share = _shared_rate(limits['share'])
+        rate = min(rate, share) if rate else share
+    if not rate:
+        return
+    now = time.monotonic()
+    total = sum(_job_state['bytes'].values())
+    window = _job_state['window']
+    # Скорость считаем по короткому окну, чтобы изменение доли сказывалось сразу
+    if window is None or now - window[0] > 2:
+        _job_state['window'] = (now, total)
+        return
+    ahead = (total - window[1]) / rate - (now - window[0])
+    if ahead > 0:
+        time.sleep(min(ahead, 1.0))
+
+
+def _track_progress(d):
+    """Progress hook that records when the first byte arrived and when the last file finished."""
+    now = time.monotonic()
+    if d.get('status') == 'downloading' and _job_state['first_byte'] is None:
+        _job_state['first_byte'] = now
+    elif d.get('status') == 'finished':
+        _job_state['first_byte'] = _job_state['first_byte'] or now
+        _job_state['downloaded'] = now
+        _job_state['done_bytes'] += d.get('total_bytes') or d.get('downloaded_bytes') or 0
+
+
+def _report_progress(d):
+    """Progress hook that sends the job's progress to the main process, at most once a second."""
+    if d.get('status') != 'downloading':
+        return
+    now = time.monotonic()
+    if now - _job_state['reported'] < 1:
+        return
+    _job_state['reported'] = now
+    # done_bytes — уже скачанные файлы задачи (видео и звук качаются по очереди),
+    # поэтому и общий размер считаем по всей задаче, а не по текущему файлу
+    total = d.get('total_bytes') or d.get('total_bytes_estimate')
+    report_progress({
+        'stage': 'download',
+        'downloaded': _job_state['done_bytes'] + (d.get('downloaded_bytes') or 0),
+        'total': _job_state['done_bytes'] + total if total else None,
+        'speed': d.get('speed'),
+        'eta': d.get('eta'),
+    })
+
+
+def _track_postprocess(d):
+    """Postprocessor hook that sums up the time spent in FFmpeg (merging, remuxing, transcoding)."""
+    now = time.monotonic()
+    if d.get('status') == 'started':
+        _job_state['pp_started'] = now
+        report_progress({'stage': 'postprocess', 'postprocessor': d.get('postprocessor')})
+    elif d.get('status') == 'finished' and _job_state['pp_started'] is not None:
+        _job_state['postprocess'] += now - _job_state['pp_started']
+        _job_state['pp_started'] = None
+
+
+def _job_metrics():
+    """Stage timings and bytes of the current job, reported back to the main process."""
+    state = _job_state
+    first_byte = state['first_byte'] or state['started']
+    return {
+        'extract': first_byte - state['started'],
+        'download': (state['downloaded'] or first_byte) - first_byte,
+        'postprocess': state['postprocess'],
+        'bytes': state['done_bytes'],
+    }
+
+
+def _get_ydl(opts):
+    profile = json.dumps(opts, sort_keys=True, default=str)
+    ydl = _ydl_profiles.get(profile)
+    if ydl is None:
+        import yt_dlp
+        ydl = yt_dlp.YoutubeDL(opts)
+        ydl.add_progress_hook(_size_guard)
+        ydl.add_progress_hook(_track_progress)
+        ydl.add_progress_hook(_bandwidth_guard)
+        ydl.add_progress_hook(_report_progress)
+        ydl.add_postprocessor_hook(_track_postprocess)
+        _ydl_profiles[profile] = ydl
+    return ydl
+
+
+# Форматы, которые Telegram воспроизводит без перекодирования
+VIDEO_FORMAT = 'bv*[vcodec^=avc1][ext=mp4]+ba[ext=m4a]/b[vcodec^=avc1][ext=mp4]/bv*[vcodec^=avc1]+ba/bv*+ba/b'
+AUDIO_FORMAT = 'ba[ext=m4a]/ba[acodec^=mp4a]/ba[ext=mp3]/ba/b'
+H264_CODECS = ('avc1', 'h264')
+AAC_CODECS = ('mp4a', 'aac')
+
+
+_transcode_pp_class = None
+
+
+def _telegram_transcode_pp(ydl, copy_video=False):
+    """
+    Postprocessor that re-encodes to H.264/AAC mp4 that Telegram plays inline.
+    With `copy_video` the (already H.264) video stream is kept and only the audio is encoded.
+    """
+    global _transcode_pp_class
+    if _transcode_pp_class is None:
+        from yt_dlp.postprocessor import FFmpegPostProcessor
+        from yt_dlp.utils import prepend_extension, replace_extension
+
+        class _TelegramTranscodePP(FFmpegPostProcessor):
+            def __init__(self, downloader=None, copy_video=False):
+                super().__init__(downloader)
+                self.copy_video = copy_video
+
+            def run(self, info):
+                path = info['filepath']
+                new_path = replace_extension(path, 'mp4')
+                temp_path = prepend_extension(new_path, 'temp')
+                if self.copy_video:
+                    self.to_screen(f'Converting audio of {path} to AAC')
+                    video_args = ['-c:v', 'copy']
+                else:
+                    self.to_screen(f'Transcoding {path} to H.264/AAC')
+                    video_args = ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23']
+                self.run_ffmpeg(path, temp_path, [
+                    *video_args, '-c:a', 'aac', '-b:a', '128k', '-movflags', '+faststart',
+                ])
+                os.replace(temp_path, new_path)
+                info['filepath'] = new_path
+                info['ext'] = 'mp4'
+                return ([path] if path != new_path else []), info
+
+        _transcode_pp_class = _TelegramTranscodePP
+    return _transcode_pp_class(ydl, copy_video=copy_video)
+
+
+def _codec(value):
+    return (value or '').lower()
+
+
+def _finalize(ydl, info, mode):
+    """
+    Makes the downloaded file playable in Telegram with as little FFmpeg work as possible.
+    Returns the path taken: 'native' (sent as is), 'remux' (container change only),
+    'audio_transcode' (H.264 video copied, only the audio re-encoded)
+    or 'transcode' (full re-encoding fallback).
+    """
+    from yt_dlp.postprocessor import FFmpegExtractAudioPP, FFmpegVideoRemuxerPP
+
+    download = info['requested_downloads'][0]
+    ext = download.get('ext')
+    vcodec = _codec(download.get('vcodec'))
+    acodec = _codec(download.get('acodec'))
+
+    if mode == 'audio':
+        if ext in ('m4a', 'mp3') and vcodec in ('', 'none'):
+            return 'native'
+        if acodec.startswith(AAC_CODECS):
+            pp, pipeline = FFmpegExtractAudioPP(ydl, preferredcodec='m4a'), 'remux'
+        elif acodec == 'mp3':
+            pp, pipeline = FFmpegExtractAudioPP(ydl, preferredcodec='mp3'), 'remux'
+        else:
+            pp, pipeline = FFmpegExtractAudioPP(ydl, preferredcodec='mp3', preferredquality='192'), 'transcode'
+    else:
+        # Если кодек неизвестен, доверяем контейнеру mp4 (так отдают TikTok и многие другие площадки)
+        video_ok = vcodec.startswith(H264_CODECS) or (not vcodec and ext == 'mp4')
+        audio_ok = acodec in ('', 'none', 'mp3') or acodec.startswith(AAC_CODECS)
+        if video_ok and audio_ok:
+            if ext == 'mp4':
+                return 'native'
+            pp, pipeline = FFmpegVideoRemuxerPP(ydl, preferedformat='mp4'), 'remux'
+        elif video_ok:
+            # Например, H.264 + Opus: видео копируем, перекодируем только звук
+            pp, pipeline = _telegram_transcode_pp(ydl, copy_video=True), 'audio_transcode'
+        else:
+            pp, pipeline = _telegram_transcode_pp(ydl), 'transcode'
+
+    info['requested_downloads'][0] = ydl.run_pp(pp, download)
+    return pipeline
+
+
+def _finish(ydl, info, mode):
+    if info and mode:
+        target = info['entries'][0] if info.get('entries') else info
+        if target.get('requested_downloads'):
+            target['tg_pipeline'] = _finalize(ydl, target, mode)
+    return ydl.sanitize_info(info) if info else None
+
+
+def _run_job(ydl, mode, budget, job_dir, bandwidth, fn, *args):
+    _job_state.update({
+        'mode': mode, 'budget': budget, 'bandwidth': bandwidth, 'window': None,
+        'bytes': {}, 'expected': {}, 'started': time.monotonic(), 'first_byte': None,
+        'downloaded': None, 'done_bytes': 0, 'postprocess': 0.0, 'pp_started': None,
+        'reported': 0.0,
+    })
+    # Каждая задача пишет в свою рабочую папку
+    default_paths = ydl.params.get('paths')
+    if job_dir:
+        ydl.params['paths'] = {'home': job_dir}
+    try:
+        return fn(*args)
+    except _SizeLimitExceeded as e:
+        return {'tg_too_large': e.args[0]}
+    finally:
+        _job_state['budget'] = None
+        _job_state['bandwidth'] = None
+        ydl.params['paths'] = default_paths
+
+
+def _extract_info(url, opts, download=True, mode=None, budget=None, job_dir=None, bandwidth=None):
+    """Runs in a worker process."""
+    ydl = _get_ydl(opts)
+    info = _run_job(ydl, mode, budget, job_dir, bandwidth, ydl.extract_info, url, download)
+    if info and info.get('tg_too_large'):
+        return info
+    info = _finish(ydl, info, mode if download else None)
+    if info and download:
+        info['tg_metrics'] = _job_metrics()
+    return info
+
+
+def _download_with_info(info, opts, mode, format_spec=None, budget=None, job_dir=None, bandwidth=None):
+    """
+    Runs in a worker process. Downloads media from an info dict returned
+    by a previous probe, without resolving the page again (like --load-info-json).
+    `format_spec` overrides the profile's format selection for this job.
+    `bandwidth` is {'rate': bytes/s or None, 'share': path of the shared ceiling or None}.
+    """
+    from yt_dlp.utils import DownloadError, ReExtractInfo
+
+    ydl = _get_ydl(opts)
+    default_selector = ydl.format_selector
+    if format_spec:
+        ydl.format_selector = ydl.build_format_selector(format_spec)
+    try:
+        result = _run_job(ydl, mode, budget, job_dir, bandwidth, ydl.process_ie_result, ydl.sanitize_info(info, True), True)
+    except (DownloadError, ReExtractInfo) as e:
+        # Ссылки на потоки могли протухнуть — извлекаем заново по исходной ссылке
+        logger.warning(f"Cached info failed to download ({e}), retrying with {info['webpage_url']}")
+        result = _run_job(ydl, mode, budget, job_dir, bandwidth, ydl.extract_info, info['webpage_url'], True)
+    finally:
+        ydl.format_selector = default_selector
+    if result and result.get('tg_too_large'):
+        return result
+    result = _finish(ydl, result, mode)
+    if result:
+        result['tg_metrics'] = _job_metrics()
+    return result
+
+
+def _backoff(base, cap, n):
+    """Exponential retry delay for yt-dlp's retry_sleep_functions."""
+    return min(cap, base * 2 ** n)
+
+
+# Настройки скорости скачивания по площадкам (ищутся по подстроке в ссылке, как MUSIC_PLATFORMS).
+# Ключи — опции yt-dlp, кроме служебных: domains, backoff (база и потолок задержки между
+# повторами, сек), ratelimit (потолок скорости одной задачи, байт/с) и adaptive (разрешить
+# DASH/HLS — имеет смысл, когда фрагменты качаются параллельно).
+# Переопределяются JSON-файлом из DOWNLOAD_PROFILES, например {"youtube": {"adaptive": true}}.
+THROUGHPUT_PROFILES = {
+    'youtube': {
+        'domains': ['youtube.com', 'youtu.be', 'ytsearch'],
+        'concurrent_fragment_downloads': 4,
+        # YouTube режет скорость на длинных запросах, поэтому качаем кусками по 10 МБ
+        'http_chunk_size': 10 * 1024 * 1024,
+        'buffersize': 64 * 1024,
+        'retries': 10,
+        'fragment_retries': 10,
+        'backoff': [1, 30],
+        # Если скорость упала ниже 100 КБ/с, yt-dlp заново извлекает ссылки на поток
+        'throttledratelimit': 100 * 1024,
+        'ratelimit': None,
+        'adaptive': False,
+    },
+    'tiktok': {
+        'domains': ['tiktok.com'],
+        'concurrent_fragment_downloads': 1,
+        'buffersize': 64 * 1024,
+        'retries': 5,
+        'fragment_retries': 5,
+        'backoff': [1, 10],
+        'ratelimit': None,
+        'adaptive': True,
+    },
+    'instagram': {
+        'domains': ['instagram.com'],
+        'concurrent_fragment_downloads': 2,
+        'retries': 5,
+        'fragment_retries': 5,
+        'backoff': [2, 30],
+        'ratelimit': None,
+        'adaptive': True,
+    },
+    'default': {
+        'domains': [],
+        'concurrent_fragment_downloads': 2,
+        'buffersize': 64 * 1024,
+        'retries': 5,
+        'fragment_retries': 5,
+        'backoff': [1, 15],
+        'ratelimit': None,
+        'adaptive': True,
+    },
+}
+
+_PROFILE_KEYS = ('domains', 'backoff', 'ratelimit', 'adaptive')
+
+
+def load_profiles(path=None):
+    """Built-in profiles merged with overrides from a JSON file (missing keys keep their defaults)."""
+    profiles = {name: dict(profile) for name, profile in THROUGHPUT_PROFILES.items()}
+    if path:
+        with open(path, encoding='utf-8') as f:
+            overrides = json.load(f)
+        for name, profile in overrides.items():
+            profiles[name] = {**profiles.get(name, profiles['default']), **profile}
+    return profiles
+
+
+class BandwidthShare:
+    """
+    Splits a global download bandwidth ceiling evenly between running jobs.
+    The per-job share lives in a small memory-mapped file that worker processes
+    read from their progress hook, so running downloads speed up or slow down
+    as other jobs start and finish.
+    """
+
+    def __init__(self, ceiling, max_jobs):
+        self.ceiling = ceiling
+        self.max_jobs = max_jobs
+        self.active = 0
+        fd, self.path = tempfile.mkstemp(prefix="gld-bandwidth-")
+        os.write(fd, _RATE.pack(ceiling))
+        os.close(fd)
+        self._file = open(self.path, 'r+b')
+        self._map = mmap.mmap(self._file.fileno(), _RATE.size)
+
+    def acquire(self):
+        self.active += 1
+        self._publish()
+
+    def release(self):
+        self.active -= 1
+        self._publish()
+
+    def _publish(self):
+        # Задачи сверх числа воркеров ждут свободный процесс и полосу не занимают
+        running = min(max(self.active, 1), self.max_jobs)
+        self._map[:_RATE.size] = _RATE.pack(self.ceiling / running)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def _warm_up():
+    """Runs in a worker process: pays for the yt-dlp import before the first real job."""
+    import yt_dlp
+    from yt_dlp.postprocessor import FFmpegPostProcessor  # noqa: F401
+    return yt_dlp.version.__version__
+
+
+def _search(query, opts):
+    """Runs in a worker process. Returns the id of the first YouTube search result."""
+    ydl = _get_ydl(opts)
+    info = ydl.extract_info(f"ytsearch1:{query}", download=False)
+    entries = (info or {}).get('entries') or []
+    return entries[0].get('id') if entries else None
+
+
+class TooLarge(Exception):
+    """The media can't fit into the Telegram upload limit."""
+
+    def __init__(self, size, limit):
+        super().__init__(f"Estimated size {size} bytes exceeds the {limit} bytes limit")
+        self.size = size
+        self.limit = limit
+
+
+def _format_size(f, duration):
+    size = f.get('filesize') or f.get('filesize_approx')
+    if not size and f.get('tbr') and duration:
+        size = f['tbr'] * 1000 / 8 * duration
+    return size
+
+
+def _is_audio_only(f):
+    return f.get('vcodec') == 'none' and f.get('acodec') not in (None, 'none')
+
+
+def _audio_rank(f):
+    return (f.get('ext') in ('m4a', 'mp3') or _codec(f.get('acodec')).startswith(AAC_CODECS), f.get('abr') or f.get('tbr') or 0)
+
+
+def _extracted_audio_size(formats, duration):
+    """Approximate size of the audio track extracted from muxed video formats, or None if unknown."""
+    bitrates = [f['abr'] for f in formats if f.get('abr') and _codec(f.get('acodec')) not in ('', 'none')]
+    if not bitrates or not duration:
+        return None
+    return max(bitrates) * 1000 / 8 * duration
+
+
+def estimate_size(info, mode):
+    """Approximate size in bytes of the file for the given mode, or None if unknown."""
+    duration = info.get('duration')
+    if mode == 'audio':
+        audio = [f for f in info.get('formats') or [] if _is_audio_only(f)]
+        if audio:
+            return _format_size(max(audio, key=_audio_rank), duration)
+        return _extracted_audio_size(info.get('formats') or [], duration)
+    if info.get('requested_formats'):
+        sizes = [_format_size(f, duration) for f in info['requested_formats']]
+        return sum(sizes) if all(sizes) else None
+    return _format_size(info, duration)
+
+
+def plan_format(info, mode, budget):
+    """
+    Picks the best format (or video+audio pair) whose known size fits into `budget` bytes.
+    Returns a format spec, None if sizes are unknown (the default selection is used
+    and the download is guarded by the size hook), or raises TooLarge when every
+    option is known to be over the budget.
+    Audio from a source without audio-only formats is extracted from the muxed video,
+    so only the extracted audio's estimated size is checked against the budget.
+    """
+    duration = info.get('duration')
+    formats = [f for f in info.get('formats') or [] if f.get('format_id') and f.get('ext') != 'mhtml']
+    audio = sorted((f for f in formats if _is_audio_only(f)), key=_audio_rank, reverse=True)
+
+    if mode == 'audio' and not audio:
+        size = _extracted_audio_size(formats, duration)
+        if size and size > budget:
+            raise TooLarge(int(size), budget)
+        return None
+
+    candidates = []  # (rank, size, spec)
+    if mode == 'audio':
+        for f in audio:
+            candidates.append((_audio_rank(f), _format_size(f, duration), f['format_id']))
+    else:
+        for f in formats:
+            vcodec, acodec = _codec(f.get('vcodec')), _codec(f.get('acodec'))
+            if vcodec in ('', 'none'):
+                continue
+            rank = (vcodec.startswith(H264_CODECS), f.get('height') or 0, f.get('tbr') or 0)
+            video_size = _format_size(f, duration)
+            if acodec not in ('', 'none'):
+                candidates.append((rank, video_size, f['format_id']))
+                continue
+            # Для раздельного видеопотока подбираем лучший аудиопоток, с которым пара влезает в лимит
+            for a in audio:
+                audio_size = _format_size(a, duration)
+                size = video_size + audio_size if video_size and audio_size else None
+                candidates.append((rank + _audio_rank(a), size, f"{f['format_id']}+{a['format_id']}"))
+                if size is None or size <= budget:
+                    break
+
+    if not candidates:
+        return None
+    fitting = [c for c in candidates if c[1] and c[1] <= budget]
+    if fitting:
+        return max(fitting, key=lambda c: c[0])[2]
+    if all(c[1] for c in candidates):
+        raise TooLarge(int(min(c[1] for c in candidates)), budget)
+    return None
+
+
 class Downloader:
-    def __init__(self, download_path="downloads"):
-        self.download_path = download_path
-        if not os.path.exists(download_path):
-            os.makedirs(download_path)
+    def __init__(self, download_path="downloads", workers=None, max_jobs_per_worker=50, job_timeout=None,
+                 probe_ttl=600, probe_failure_ttl=60, probe_cache_size=200, max_bytes=50 * 1024 * 1024,
+                 disk_quota_bytes=2 * 1024 * 1024 * 1024, job_max_age=3600, profiles=None, bandwidth_ceiling=None,
+                 resolver_cache=None):
+        # Каждый процесс пишет в свою подпапку: чистильщик другого процесса её не тронет
+        self.download_path = process_root(download_path)
+        self.max_bytes = max_bytes
+        self.job_timeout = job_timeout
+        self.pool = WorkerPool(workers, max_jobs_per_worker)
+        self.profiles = profiles or load_profiles()
+        # Общий потолок скорости скачивания (байт/с), делится поровну между идущими загрузками
+        self.bandwidth = BandwidthShare(bandwidth_ceiling, self.pool.size) if bandwidth_ceiling else None
+        # Ссылки Spotify / Яндекс Музыки сопоставляются с роликами YouTube (с постоянным кэшем)
+        self.resolver = TrackResolver(resolver_cache or ResolverCache(), search=self._search_youtube)
+        self.probe_ttl = probe_ttl
+        self.probe_failure_ttl = probe_failure_ttl
+        self.probe_cache_size = probe_cache_size
+        # url -> (timestamp, info); информация о медиа, полученная до нажатия кнопки.
+        # info=None — разбор не удался или это не одиночное видео (хранится probe_failure_ttl секунд)
+        self._probe_cache = OrderedDict()
+        self._probes = {}
+        os.makedirs(self.download_path, exist_ok=True)
+        self._extractors = None
+        # Рабочие папки задач, которые ещё скачиваются или ждут отправки
+        self._active_dirs = set()
+        self.janitor = DiskJanitor(
+            self.download_path, lambda path: os.path.abspath(path) in self._active_dirs,
+            quota_bytes=disk_quota_bytes, max_age=job_max_age,
+        )
+        REGISTRY.on_collect(self._collect_metrics)
 
-    async def download(self, url: str, mode: str = "video") -> str:
+    def _collect_metrics(self):
+        WORKERS_BUSY.set(self.pool.stats()['busy'])
+
+    def media_key(self, url: str, mode: str):
         """
-        Downloads media from URL.
-        mode: 'video' or 'audio'
-        Returns the path to the downloaded file.
+        Returns a cache key (extractor, media id, mode) for the URL without network access,
+        or None if the media id can't be determined from the URL or a cached probe.
         """
-        # Workaround for platforms with DRM or limited support (Spotify, Yandex Music)
-        # Search on YouTube instead
-        music_platforms = ["spotify.com", "music.yandex", "yandex.ru/music"]
-        if any(platform in url for platform in music_platforms):
-            mode = "audio" # These are always audio
-            url = f"ytsearch1:{url} audio"
-            logger.info(f"Music platform detected, searching on YouTube: {url}")
+        if is_music_url(url):
+            video_id = self.resolver.cached(url)
+            return f"Youtube:{video_id}:{mode}" if video_id else None
+        info = self.cached_info(url)
+        if info and info.get('extractor_key') and info.get('id'):
+            return f"{info['extractor_key']}:{info['id']}:{mode}"
+        for ie in self._load_extractors():
+            if ie.suitable(url):
+                if ie.ie_key() == 'Generic':
+                    return None
+                media_id = ie.get_temp_id(url)
+                if not media_id:
+                    return None
+                return f"{ie.ie_key()}:{media_id}:{mode}"
+        return None
+
+    def _load_extractors(self):
+        if self._extractors is None:
+            from yt_dlp.extractor import gen_extractor_classes
+            self._extractors = list(gen_extractor_classes())
+        return self._extractors
+
+    async def warm_up(self):
+        """
+        Loads yt-dlp and the extractor list in the background and starts the worker
+        processes, so the first user request doesn't pay for it.
+        Meant to run after the bot has started accepting updates.
+        """
+        started = time.monotonic()
+        await asyncio.to_thread(self._load_extractors)
+        results = await asyncio.gather(
+            *(self.pool.run(_warm_up, timeout=self.job_timeout) for _ in range(self.pool.size)),
+            return_exceptions=True,
+        )
+        failed = [r for r in results if isinstance(r, Exception)]
+        if failed:
+            logger.warning(f"Worker warm-up failed: {failed[0]}")
+        logger.info(f"Warm-up finished in {time.monotonic() - started:.1f}s "
+                    f"({len(self._extractors)} extractors, {self.pool.size - len(failed)} workers ready)")
 
-        loop = asyncio.get_event_loop()
-        
+    def profile_for(self, url):
+        for name, profile in self.profiles.items():
+            if any(domain in url for domain in profile.get('domains', ())):
+                return profile
+        return self.profiles['default']
+
+    def _base_opts(self, url):
+        profile = self.profile_for(url)
         ydl_opts = {
-            # Для сервера (с FFmpeg) выбираем лучшие раздельные потоки для максимального качества
-            'format': 'bestvideo+bestaudio/best' if mode == 'video' else 'bestaudio/best',
-            'outtmpl': f'{self.download_path}/%(title).50s_%(id)s.%(ext)s',
             'noplaylist': True,
             'quiet': True,
             'no_warnings': True,
@@ -42,74 +653,234 @@ class Downloader:
             'extractor_args': {
                 'youtube': {
                     'player_client': ['ios', 'android', 'web'],
-                    'skip': ['dash', 'hls']
                 }
             }
         }
+        # DASH/HLS отключены, пока профиль не разрешит их (нужны параллельные фрагменты, чтобы это окупилось)
+        if not profile.get('adaptive'):
+            ydl_opts['extractor_args']['youtube']['skip'] = ['dash', 'hls']
+        ydl_opts.update({key: value for key, value in profile.items() if key not in _PROFILE_KEYS and value is not None})
+        if profile.get('backoff'):
+            backoff = functools.partial(_backoff, *profile['backoff'])
+            ydl_opts['retry_sleep_functions'] = {'http': backoff, 'fragment': backoff, 'extractor': backoff}
 
         # Если в папке бота есть файл cookies.txt, используем его для авторизации
         if os.path.exists("cookies.txt"):
             ydl_opts['cookiefile'] = 'cookies.txt'
             logger.info("Using cookies.txt for authentication")
+        return ydl_opts
+
+    def _cached_probe(self, url):
+        """Returns (hit, info); a remembered failure is a hit with info None."""
+        entry = self._probe_cache.get(url)
+        if entry is None:
+            return False, None
+        ttl = self.probe_ttl if entry[1] is not None else self.probe_failure_ttl
+        if time.monotonic() - entry[0] > ttl:
+            del self._probe_cache[url]
+            return False, None
+        return True, entry[1]
+
+    def cached_info(self, url: str):
+        return self._cached_probe(url)[1]
+
+    async def probe(self, url: str):
+        """
+        Resolves media info without downloading and caches it for `probe_ttl` seconds,
+        so a following download() doesn't have to extract the page again.
+        Concurrent probes of the same URL share one extraction. Returns the info dict or None.
+        A failed probe (or a link that isn't a single video) is remembered for `probe_failure_ttl`
+        seconds, so download() goes straight to a full extraction instead of probing again.
+        """
+        if is_music_url(url):
+            # Пока пользователь выбирает формат, заодно находим трек на YouTube
+            resolved = await self.resolver.resolve(url)
+            return await self.probe(resolved) if resolved else None
+        hit, info = self._cached_probe(url)
+        if hit:
+            return info
+        task = self._probes.get(url)
+        if task is None:
+            task = asyncio.ensure_future(self._probe(url))
+            self._probes[url] = task
+            task.add_done_callback(lambda t: self._probes.pop(url, None))
+        return await asyncio.shield(task)
+
+    async def _search_youtube(self, query):
+        ydl_opts = self._base_opts('ytsearch')
+        ydl_opts['extract_flat'] = 'in_playlist'
+        return await self.pool.run(_search, f"{query} audio", ydl_opts, timeout=self.job_timeout)
+
+    async def _probe(self, url):
+        ydl_opts = self._base_opts(url)
+        ydl_opts['format'] = VIDEO_FORMAT
+        try:
+            with STAGE_SECONDS.time(stage='probe'):
+                info = await self.pool.run(_extract_info, url, ydl_opts, download=False, timeout=self.job_timeout)
+        except Exception as e:
+            logger.warning(f"Probe failed for {url}: {e}")
+            info = None
+        # Плейлисты и поисковые выдачи скачиваются по ссылке: запоминаем их, как неудачный разбор
+        if info and info.get('_type', 'video') != 'video':
+            info = None
+        self._probe_cache[url] = (time.monotonic(), info)
+        self._probe_cache.move_to_end(url)
+        while len(self._probe_cache) > self.probe_cache_size:
+            self._probe_cache.popitem(last=False)
+        return info
 
-        if mode == 'audio':
-            ydl_opts.update({
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': '192',
-                }],
-            })
-        elif mode == 'video':
-             ydl_opts.update({
-                'postprocessors': [{
-                    'key': 'FFmpegVideoConvertor',
-                    'preferedformat': 'mp4',
-                }],
-            })
+    async def download(self, url: str, mode: str = "video", on_progress=None) -> str:
+        """
+        Downloads media from URL.
+        mode: 'video' or 'audio'
+        on_progress: called with {'stage': 'extract'} once a worker process has picked the job up,
+        with {'stage': 'download', 'downloaded', 'total', 'speed', 'eta'} about once a second
+        and with {'stage': 'postprocess', 'postprocessor'} when FFmpeg starts.
+        Returns the path to the downloaded file.
+        Raises TooLarge if the media can't fit into the upload limit.
+        Cancelling the call kills the worker's process group, stopping the download and any FFmpeg it started.
+        """
+        # Workaround for platforms with DRM or limited support (Spotify, Yandex Music)
+        # Search on YouTube instead
+        if is_music_url(url):
+            mode = "audio" # These are always audio
+            resolved = await self.resolver.resolve(url)
+            if resolved:
+                logger.info(f"Music platform detected, resolved {url} to {resolved}")
+                url = resolved
+            else:
+                url = f"ytsearch1:{url} audio"
+                logger.info(f"Music platform detected, could not resolve the track, searching on YouTube: {url}")
 
+        ydl_opts = self._base_opts(url)
+        ydl_opts.update({
+            # Предпочитаем потоки, которые Telegram играет без перекодирования;
+            # FFmpeg запускается только если без него не обойтись (см. _finalize)
+            'format': VIDEO_FORMAT if mode == 'video' else AUDIO_FORMAT,
+            'merge_output_format': 'mp4/mkv',
+            # Путь задаётся относительно рабочей папки задачи (paths.home)
+            'outtmpl': '%(title).50s_%(id)s.%(ext)s',
+            # max_filesize не задаём: yt-dlp молча пропускает такой файл, а _size_guard
+            # отказывает так же рано (по размеру из заголовков) и сообщает TooLarge
+        })
+
+        job_dir = os.path.abspath(tempfile.mkdtemp(prefix="job_", dir=self.download_path))
+        self._active_dirs.add(job_dir)
+        filename = None
+        result = 'failed'
+        bandwidth = {
+            'rate': self.profile_for(url).get('ratelimit'),
+            'share': self.bandwidth.path if self.bandwidth else None,
+        }
+        if self.bandwidth:
+            self.bandwidth.acquire()
         try:
-            # We use run_in_executor because yt_dlp is synchronous
-            info = await loop.run_in_executor(None, lambda: self._extract_info(url, ydl_opts))
+            # Используем уже разобранную ссылку (этап probe) и выбираем формат, который влезет в лимит Telegram
+            probed = await self.probe(url)
+            # yt_dlp is synchronous and CPU-heavy, so it runs in a separate worker process
+            on_start = (lambda: on_progress({'stage': 'extract'})) if on_progress else None
+            if probed:
+                format_spec = plan_format(probed, mode, self.max_bytes)
+                info = await self.pool.run(_download_with_info, probed, ydl_opts, mode, format_spec, self.max_bytes,
+                                           job_dir, bandwidth, timeout=self.job_timeout, on_progress=on_progress,
+                                           on_start=on_start)
+            else:
+                info = await self.pool.run(_extract_info, url, ydl_opts, mode=mode, budget=self.max_bytes,
+                                           job_dir=job_dir, bandwidth=bandwidth, timeout=self.job_timeout,
+                                           on_progress=on_progress, on_start=on_start)
             if not info:
                 logger.error(f"yt-dlp returned no info for {url}")
                 return None
+            if info.get('tg_too_large'):
+                raise TooLarge(info['tg_too_large'], self.max_bytes)
+            self._record_metrics(info)
             
-            filename = self._get_filename(info, mode)
+            filename = self._get_filepath(info, mode)
             if not filename:
                 logger.error(f"Could not determine filename for {url}")
                 return None
+            result = 'ok'
             return filename
+        except TooLarge as e:
+            logger.info(f"Rejected {url} ({mode}): {e}")
+            result = 'too_large'
+            raise
+        except asyncio.CancelledError:
+            logger.info(f"Download of {url} ({mode}) cancelled")
+            result = 'cancelled'
+            raise
         except Exception as e:
             logger.error(f"CRITICAL Error downloading {url}: {e}", exc_info=True)
             return None
+        finally:
+            if self.bandwidth:
+                self.bandwidth.release()
+            DOWNLOADS.inc(mode=mode, result=result)
+            # Папку удаляет cleanup() после отправки файла; при неудаче — сразу
+            if not filename:
+                self._remove_job_dir(job_dir)
+
+    @staticmethod
+    def _record_metrics(info):
+        job = info.get('tg_metrics') or {}
+        for stage in ('extract', 'download', 'postprocess'):
+            if stage in job:
+                STAGE_SECONDS.observe(job[stage], stage=stage)
+        BYTES.inc(job.get('bytes', 0), direction='downloaded')
 
-    def _extract_info(self, url, opts):
-        with yt_dlp.YoutubeDL(opts) as ydl:
-            return ydl.extract_info(url, download=True)
+    def cleanup(self, file_path):
+        """Removes the job directory of a file returned by download()."""
+        if file_path:
+            self._remove_job_dir(os.path.dirname(os.path.abspath(file_path)))
 
-    def _get_filename(self, info, mode):
+    def _remove_job_dir(self, job_dir):
+        self._active_dirs.discard(job_dir)
+        shutil.rmtree(job_dir, ignore_errors=True)
+
+    def _get_filepath(self, info, mode):
         # If it was a search, info will contain 'entries'
         if 'entries' in info and len(info['entries']) > 0:
             info = info['entries'][0]
 
-        # yt-dlp might change extension after post-processing
-        ext = 'mp3' if mode == 'audio' else 'mp4'
-        
-        # If it's a playlist or something else, it might be different, but noplaylist is True
-        # The outtmpl uses title and id
-        base_path = f"{self.download_path}/{info['title'][:50]}_{info['id']}"
-        
-        # Check if the file exists with the expected extension or the one from info
-        possible_file = f"{base_path}.{ext}"
-        if os.path.exists(possible_file):
-            return possible_file
-        
-        # Fallback: check what yt-dlp actually saved
-        for f in os.listdir(self.download_path):
-            if info['id'] in f:
-                return os.path.join(self.download_path, f)
-        
+        logger.info(f"{info.get('extractor_key')}:{info['id']} ({mode}) delivered via {info.get('tg_pipeline')}")
+        # Итоговый путь (после пост-обработки) сообщает сам yt-dlp
+        downloads = info.get('requested_downloads') or []
+        if downloads and downloads[0].get('filepath') and os.path.exists(downloads[0]['filepath']):
+            return downloads[0]['filepath']
         return None
 
-downloader = Downloader()
+    def start(self):
+        self.janitor.start()
+
+    async def close(self):
+        await self.janitor.stop()
+        await self.pool.shutdown()
+        if self.bandwidth:
+            self.bandwidth.close()
+        self.resolver.cache.close()
+
+
+def create_downloader(workers=None):
+    """
+    Builds the bot's Downloader from environment variables.
+    `workers` is the default pool size; DOWNLOAD_WORKERS overrides it.
+    Called by the main process only: worker processes import this module to run
+    the job functions and must not open caches, temp files or the janitor.
+    """
+    return Downloader(
+        workers=int(os.getenv("DOWNLOAD_WORKERS", "0")) or workers,
+        max_jobs_per_worker=int(os.getenv("WORKER_MAX_JOBS", "50")),
+        job_timeout=int(os.getenv("DOWNLOAD_TIMEOUT", "600")) or None,
+        probe_ttl=int(os.getenv("PROBE_TTL", "600")),
+        # Лимит Bot API на отправку файлов — 50 МБ (с локальным Bot API сервером можно больше)
+        max_bytes=int(os.getenv("MAX_UPLOAD_BYTES", str(50 * 1024 * 1024))),
+        disk_quota_bytes=int(os.getenv("DISK_QUOTA_MB", "2048")) * 1024 * 1024,
+        job_max_age=int(os.getenv("JOB_MAX_AGE", "3600")),
+        profiles=load_profiles(os.getenv("DOWNLOAD_PROFILES")),
+        # 0 — без общего ограничения
+        bandwidth_ceiling=float(os.getenv("DOWNLOAD_BANDWIDTH_MBPS", "0")) * 1024 * 1024 or None,
+        resolver_cache=ResolverCache(
+            os.getenv("RESOLVER_DB", "resolver_cache.db"),
+            ttl=int(os.getenv("RESOLVER_TTL", str(30 * 24 * 3600))),
+        ),
+    )
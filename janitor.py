@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import os
+import shutil
+import socket
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def process_root(base):
+    """
+    Scratch root of this process, `base/<hostname>-<pid>`: processes sharing `base`
+    (several workers on one host or on a shared volume) never see each other's jobs.
+    """
+    return os.path.join(base, f"{socket.gethostname()}-{os.getpid()}")
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class DiskJanitor:
+    """
+    Keeps the per-job scratch directories under `root` (see process_root) in check.
+    Only this process's root is swept; roots of other processes are left alone
+    unless they belong to a process on this host that is no longer running.
+    Directories of finished jobs that were not cleaned up are removed after `grace` seconds,
+    any directory older than `max_age` is removed, and when the total size exceeds
+    `quota_bytes` the oldest directories are evicted first.
+    """
+
+    def __init__(self, root, is_active, quota_bytes, max_age=3600, interval=60, grace=60):
+        self.root = root
+        self.is_active = is_active
+        self.quota_bytes = quota_bytes
+        self.max_age = max_age
+        self.interval = interval
+        self.grace = grace
+        self._task = None
+
+    def recover(self):
+        """
+        Startup recovery: nothing of this process is running yet, so every scratch directory
+        in its root is a leftover, and so are the roots of dead processes on this host.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        removed = 0
+        for entry in os.scandir(self.root):
+            self._remove(entry.path)
+            removed += 1
+        if removed:
+            logger.info(f"Removed {removed} leftover job directories from {self.root}")
+
+        base = os.path.dirname(self.root)
+        prefix = f"{socket.gethostname()}-"
+        for entry in os.scandir(base):
+            pid = entry.name[len(prefix):]
+            if entry.name.startswith(prefix) and pid.isdigit() and entry.path != self.root and not _alive(int(pid)):
+                logger.info(f"Removing scratch root of exited process {entry.path}")
+                self._remove(entry.path)
+
+    def sweep(self):
+        now = time.time()
+        dirs = []
+        for entry in os.scandir(self.root):
+            try:
+                age = now - entry.stat().st_mtime
+            except OSError:
+                continue
+            if age > self.max_age or (age > self.grace and not self.is_active(entry.path)):
+                logger.warning(f"Janitor: removing stale job directory {entry.path} (age {int(age)}s)")
+                self._remove(entry.path)
+            else:
+                dirs.append((age, entry.path, _dir_size(entry.path)))
+
+        total = sum(size for _, _, size in dirs)
+        for age, path, size in sorted(dirs, reverse=True):
+            if total <= self.quota_bytes:
+                break
+            logger.warning(f"Janitor: disk quota exceeded ({total} > {self.quota_bytes}), evicting {path}")
+            self._remove(path)
+            total -= size
+        return total
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.sweep)
+            except Exception as e:
+                logger.error(f"Janitor sweep failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self.recover()
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    @staticmethod
+    def _remove(path):
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -1,15 +1,35 @@
+import time
+# Отсчёт времени запуска — до тяжёлых импортов
+STARTED_AT = time.monotonic()
+
 import logging
 import os
 import asyncio
+import signal
 from datetime import datetime
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.types import FSInputFile, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from dotenv import load_dotenv
-from downloader import downloader
 
+# Загружаем .env до импорта модулей, которые читают настройки из окружения
 load_dotenv()
 
+from downloader import create_downloader, estimate_size, is_music_url, TooLarge
+from media_cache import media_cache, extract_file_id
+from subscriptions import SubscriptionChecker
+from storage import StatsStore
+from broadcast import BroadcastEngine
+from scheduler import DownloadScheduler, QuotaExceeded, JobCancelled
+from state import create_backend, MemoryBackend
+import metrics
+from metrics import STAGE_SECONDS, DOWNLOADS, BYTES, TELEGRAM_SENDS
+
 TOKEN = os.getenv("BOT_TOKEN")
 if not TOKEN:
     raise ValueError("BOT_TOKEN is not set in environment variables")
@@ -19,12 +39,60 @@ FREE_VIDEO_LIMIT = 7
 FREE_AUDIO_LIMIT = 15
 BONUS_LIMIT = 4
 
-# Глобальный ограничитель одновременных загрузок
-download_semaphore = asyncio.Semaphore(10)
+# Роль процесса: all — всё в одном процессе, frontend — только обработка обновлений Telegram,
+# worker — только загрузки из общей очереди (можно запускать на нескольких машинах)
+ROLE = os.getenv("ROLE", "all")
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "4"))
+PENDING_TTL = 24 * 3600
+
+# Общее состояние процессов: memory:// (по умолчанию), sqlite:///state.db или redis://...
+state = create_backend(os.getenv("STATE_URL", "memory://"))
+if ROLE != "all" and isinstance(state, MemoryBackend):
+    raise ValueError(f"ROLE={ROLE} needs a shared STATE_URL (sqlite:// or redis://)")
+
+# Режим получения обновлений: polling (локальная разработка) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8080")))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+# Отдельный порт для /metrics (в режиме webhook метрики доступны и на порту вебхука)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# Сколько секунд ждать завершения начатых обработчиков при остановке
+DRAIN_TIMEOUT = int(os.getenv("DRAIN_TIMEOUT", "60"))
+
+# Планировщик загрузок: отдельные линии для видео и аудио, не больше USER_JOB_LIMIT задач на пользователя
+VIDEO_SLOTS = int(os.getenv("VIDEO_SLOTS", "6"))
+AUDIO_SLOTS = int(os.getenv("AUDIO_SLOTS", "4"))
+USER_JOB_LIMIT = int(os.getenv("USER_JOB_LIMIT", "2"))
+# Процессов загрузки по одному на слот и ещё PROBE_WORKERS сверху: разбор ссылок и поиск
+# не ждут, пока освободится загрузка (DOWNLOAD_WORKERS задаёт размер пула явно)
+PROBE_WORKERS = int(os.getenv("PROBE_WORKERS", "2"))
+downloader = create_downloader(workers=VIDEO_SLOTS + AUDIO_SLOTS + PROBE_WORKERS)
+# При ROLE=frontend ограничение на пользователя считается по счётчику в общем состоянии (см. process_download),
+# а воркер берёт задачи из очереди по мере освобождения
+download_scheduler = DownloadScheduler(
+    {"video": VIDEO_SLOTS, "audio": AUDIO_SLOTS},
+    per_user_limit=USER_JOB_LIMIT if ROLE == "all" else None,
+)
+# Как часто обновлять статус загрузки и проверять кнопку отмены, сек
+PROGRESS_INTERVAL = float(os.getenv("PROGRESS_INTERVAL", "3"))
+# Задача, которая столько секунд не сообщала о ходе скачивания, считается зависшей и отменяется
+JOB_STALL_TIMEOUT = int(os.getenv("JOB_STALL_TIMEOUT", "300"))
+# Сколько живёт счётчик задач пользователя, если воркер упал и не вернул результат, сек
+ACTIVE_JOBS_TTL = int(os.getenv("ACTIVE_JOBS_TTL", "3600"))
+
+# Свой Bot API сервер (локальный telegram-bot-api или заглушка из bench/); по умолчанию api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
 
 logging.basicConfig(level=logging.INFO)
-bot = Bot(token=TOKEN)
+bot = Bot(
+    token=TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None,
+)
 dp = Dispatcher()
+subscriptions = SubscriptionChecker(bot, CHANNELS, ttl=int(os.getenv("SUBS_CACHE_TTL", "60")))
 
 # Главное меню
 main_menu = ReplyKeyboardMarkup(
@@ -35,35 +103,34 @@ main_menu = ReplyKeyboardMarkup(
     resize_keyboard=True
 )
 
-import json
-
 ADMIN_ID = 8566608157
 
 # Хранилище данных пользователей
 STATS_FILE = "user_stats.json"
+STATS_DB = os.getenv("STATS_DB", "user_stats.db")
+
+# Статистика и рассылка нужны только ролям, которые принимают обновления: воркер базу пользователей не открывает
+stats_store = broadcaster = None
+if ROLE in ("all", "frontend"):
+    stats_store = StatsStore(STATS_DB, json_path=STATS_FILE)
+    logging.info(f"Initialized in {time.monotonic() - STARTED_AT:.2f}s ({stats_store.count_users()} users loaded)")
+    broadcaster = BroadcastEngine(
+        bot, stats_store,
+        rate=float(os.getenv("BROADCAST_RATE", "25")),
+        workers=int(os.getenv("BROADCAST_WORKERS", "10")),
+    )
 
-def load_stats():
-    if os.path.exists(STATS_FILE):
-        try:
-            with open(STATS_FILE, "r") as f:
-                data = json.load(f)
-                # Убеждаемся, что есть список всех пользователей
-                if "all_users" not in data:
-                    data["all_users"] = []
-                return data
-        except:
-            return {"all_users": []}
-    return {"all_users": []}
-
-def save_stats():
-    with open(STATS_FILE, "w") as f:
-        json.dump(user_stats, f)
-
-user_stats = load_stats()
-pending_downloads = {}
-
-# Глобальное состояние для рассылки
-broadcast_state = {}
+def pending_key(chat_id, msg_id):
+    return f"pending:{chat_id}:{msg_id}"
+
+def cancel_key(chat_id, status_message_id):
+    return f"cancel:{chat_id}:{status_message_id}"
+
+def broadcast_key(user_id):
+    return f"broadcast:{user_id}"
+
+def active_jobs_key(user_id):
+    return f"active:{user_id}"
 
 def get_user_limits(user_id, sub_count):
     bonus = BONUS_LIMIT * sub_count
@@ -73,34 +140,49 @@ def get_user_limits(user_id, sub_count):
     }
 
 async def get_subs_count(user_id):
-    count = 0
-    for channel in CHANNELS:
-        try:
-            member = await bot.get_chat_member(chat_id=channel, user_id=int(user_id))
-            if member.status not in ["left", "kicked"]:
-                count += 1
-        except Exception as e:
-            logging.error(f"Error checking sub for {channel}: {e}")
-    return count
+    with STAGE_SECONDS.time(stage="subscription_check"):
+        return await subscriptions.get_count(user_id)
+
+async def send_media(chat_id, mode, media):
+    method = "send_video" if mode == "video" else "send_audio"
+    try:
+        with STAGE_SECONDS.time(stage="upload"):
+            if mode == "video":
+                sent = await bot.send_video(chat_id, video=media)
+            else:
+                sent = await bot.send_audio(chat_id, audio=media)
+    except Exception:
+        TELEGRAM_SENDS.inc(method=method, result="error")
+        raise
+    TELEGRAM_SENDS.inc(method=method, result="ok")
+    if isinstance(media, FSInputFile):
+        BYTES.inc(os.path.getsize(media.path), direction="uploaded")
+    return sent
+
+@metrics.REGISTRY.on_collect
+def collect_scheduler_metrics():
+    for mode, lane in download_scheduler.stats().items():
+        metrics.SLOTS_BUSY.set(lane["running"], mode=mode)
+        metrics.SLOTS_TOTAL.set(lane["slots"], mode=mode)
+        metrics.QUEUE_DEPTH.set(lane["queued"], mode=mode)
+
+def format_size(size):
+    return f"~{size / 1024 / 1024:.1f} МБ" if size else "?"
+
+def format_media_info(info):
+    duration = int(info.get("duration") or 0)
+    minutes, seconds = divmod(duration, 60)
+    hours, minutes = divmod(minutes, 60)
+    length = f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+    text = f"📄 {info.get('title', '')[:100]}\n"
+    if duration:
+        text += f"⏱ {length} | "
+    text += f"📦 Видео: {format_size(estimate_size(info, 'video'))}, Аудио: {format_size(estimate_size(info, 'audio'))}"
+    return text
 
 def reset_daily_stats(user_id, username=None):
     today = datetime.now().date().isoformat()
-    user_id_str = str(user_id)
-    
-    # Добавляем пользователя и юзернейм
-    if "usernames" not in user_stats:
-        user_stats["usernames"] = {}
-    if username:
-        user_stats["usernames"][user_id_str] = f"@{username}"
-    
-    if user_id_str not in user_stats.get("all_users", []):
-        if "all_users" not in user_stats:
-            user_stats["all_users"] = []
-        user_stats["all_users"].append(user_id_str)
-
-    if user_id_str not in user_stats or user_stats[user_id_str].get('last_reset') != today:
-        user_stats[user_id_str] = {'video': 0, 'audio': 0, 'last_reset': today}
-        save_stats()
+    return stats_store.touch_user(user_id, username, today)
 
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message):
@@ -130,6 +212,8 @@ async def admin_panel(message: types.Message):
 
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="📊 Статистика", callback_data="admin_stats")],
+        [InlineKeyboardButton(text="📈 Метрики", callback_data="admin_metrics")],
+        [InlineKeyboardButton(text="🧰 Задачи", callback_data="admin_jobs")],
         [InlineKeyboardButton(text="📢 Рассылка", callback_data="admin_broadcast")]
     ])
     await message.answer("🛠 **Панель администратора**", reply_markup=kb)
@@ -138,8 +222,8 @@ async def admin_panel(message: types.Message):
 async def show_stats(callback: types.CallbackQuery):
     if callback.from_user.id != ADMIN_ID: return
     
-    total_users = len(user_stats.get("all_users", []))
-    active_today = sum(1 for k, v in user_stats.items() if k not in ["all_users", "usernames"] and isinstance(v, dict) and v.get("last_reset") == datetime.now().date().isoformat())
+    total_users = stats_store.count_users()
+    active_today = stats_store.count_active(datetime.now().date().isoformat())
     
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="👥 Список пользователей", callback_data="admin_users_0")],
@@ -153,38 +237,158 @@ async def show_stats(callback: types.CallbackQuery):
         reply_markup=kb
     )
 
+STAGE_NAMES = {
+    "queue_wait": "Очередь",
+    "subscription_check": "Проверка подписок",
+    "probe": "Разбор ссылки",
+    "extract": "Извлечение",
+    "download": "Скачивание",
+    "postprocess": "FFmpeg",
+    "upload": "Отправка в Telegram",
+}
+
+@dp.callback_query(F.data == "admin_metrics")
+async def show_metrics(callback: types.CallbackQuery):
+    if callback.from_user.id != ADMIN_ID: return
+
+    metrics.REGISTRY.collect()
+    lines = ["📈 **Метрики**", ""]
+    for mode, lane in download_scheduler.stats().items():
+        lines.append(f"{'🎬' if mode == 'video' else '🎵'} Слоты: {lane['running']}/{lane['slots']}, в очереди: {lane['queued']}")
+    workers = downloader.pool.stats()
+    lines.append(f"⚙️ Воркеры: {workers['busy']}/{workers['size']} заняты, ждут процесса: {workers['waiting']}")
+
+    count = lambda result: int(sum(DOWNLOADS.value(mode=mode, result=result) for mode in ("video", "audio")))
+    lines.append(f"📥 Загрузки: ✅ {count('ok')} | ♻️ из кэша {count('cache_hit')} | ❌ {count('failed')} | 📦 слишком большие {count('too_large')} | 🚫 отменены {count('cancelled')}")
+    lines.append(f"🔄 Трафик: скачано {BYTES.value(direction='downloaded') / 1024 / 1024:.1f} МБ, "
+                 f"отправлено {BYTES.value(direction='uploaded') / 1024 / 1024:.1f} МБ")
+
+    lines.append("\n⏱ Этапы (p50 / p95, сек):")
+    for stage, name in STAGE_NAMES.items():
+        n = STAGE_SECONDS.count(stage=stage)
+        if n:
+            p50, p95 = STAGE_SECONDS.quantile(0.5, stage=stage), STAGE_SECONDS.quantile(0.95, stage=stage)
+            lines.append(f"• {name}: {p50:.2f} / {p95:.2f} ({n})")
+
+    commit_p95 = metrics.STORE_COMMIT_SECONDS.quantile(0.95)
+    if commit_p95 is not None:
+        lines.append(f"\n💾 Коммит БД p95: {commit_p95 * 1000:.1f} мс")
+
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_metrics")],
+        [InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_back")]
+    ])
+    try:
+        await callback.message.edit_text("\n".join(lines), reply_markup=kb)
+    except TelegramBadRequest:
+        # Цифры не изменились с прошлого нажатия
+        await callback.answer()
+
+def format_progress(progress):
+    if not progress:
+        return "ждёт свободный процесс"
+    if progress["stage"] == "extract":
+        return "разбор ссылки"
+    if progress["stage"] == "postprocess":
+        return "обработка FFmpeg"
+    downloaded, total = progress["downloaded"], progress.get("total")
+    text = f"{downloaded / 1024 / 1024:.1f}"
+    if total:
+        text += f"/{total / 1024 / 1024:.1f} МБ ({min(downloaded / total, 1):.0%})"
+    else:
+        text += " МБ"
+    if progress.get("speed"):
+        text += f" · {progress['speed'] / 1024 / 1024:.1f} МБ/с"
+    if progress.get("eta") is not None and progress.get("speed"):
+        minutes, seconds = divmod(int(progress["eta"]), 60)
+        text += f" · ~{minutes}:{seconds:02d}"
+    return text
+
+@dp.callback_query(F.data == "admin_jobs")
+async def show_jobs(callback: types.CallbackQuery):
+    if callback.from_user.id != ADMIN_ID: return
+
+    # Только задачи этого процесса: при ROLE=frontend загрузки идут на воркерах
+    jobs = download_scheduler.jobs()
+    now = time.monotonic()
+    lines = ["🧰 **Задачи**", ""]
+    buttons = []
+    for job in jobs[:20]:
+        icon = "🎬" if job.mode == "video" else "🎵"
+        if job.started:
+            status = f"{int(now - job.queued_at)} с · {format_progress(job.progress)}"
+        else:
+            status = f"в очереди {int(now - job.queued_at)} с"
+        lines.append(f"#{job.id} {icon} `{job.user_id}` · {status}")
+        buttons.append(InlineKeyboardButton(text=f"⛔ #{job.id}", callback_data=f"admin_kill_{job.id}"))
+    if not jobs:
+        lines.append("Нет активных загрузок")
+    elif len(jobs) > 20:
+        lines.append(f"… и ещё {len(jobs) - 20}")
+
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        *(buttons[i:i + 4] for i in range(0, len(buttons), 4)),
+        [InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_jobs")],
+        [InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_back")]
+    ])
+    try:
+        await callback.message.edit_text("\n".join(lines), reply_markup=kb)
+    except TelegramBadRequest:
+        await callback.answer()
+
+@dp.callback_query(F.data.startswith("admin_kill_"))
+async def kill_job(callback: types.CallbackQuery):
+    if callback.from_user.id != ADMIN_ID: return
+
+    job_id = int(callback.data.split("_")[2])
+    job = next((job for job in download_scheduler.jobs() if job.id == job_id), None)
+    if job is None:
+        await callback.answer("Задача уже завершилась")
+    else:
+        download_scheduler.cancel(job, "admin")
+        logging.info(f"Admin cancelled job #{job_id} ({job.key})")
+        await callback.answer(f"Задача #{job_id} остановлена")
+    await show_jobs(callback)
+
 @dp.callback_query(F.data.startswith("admin_users_"))
 async def list_users(callback: types.CallbackQuery):
     if callback.from_user.id != ADMIN_ID: return
     
-    page = int(callback.data.split("_")[2])
-    users = user_stats.get("all_users", [])
+    # admin_users_<page>[_a<seq>|_b<seq>]: страница и курсор (после/до записи seq)
+    parts = callback.data.split("_")
+    page = int(parts[2])
+    cursor = parts[3] if len(parts) > 3 else "a0"
     per_page = 10
-    start = page * per_page
-    end = start + per_page
     
-    current_users = users[start:end]
+    if cursor[0] == "b":
+        current_users = stats_store.list_users(per_page, before=int(cursor[1:]))
+        has_next = True
+    else:
+        # Запрашиваем на одну запись больше, чтобы понять, есть ли следующая страница
+        current_users = stats_store.list_users(per_page + 1, after=int(cursor[1:]))
+        has_next = len(current_users) > per_page
+        current_users = current_users[:per_page]
     if not current_users:
         await callback.answer("Больше пользователей нет")
         return
 
     text = f"👥 **Список пользователей (Стр. {page + 1})**\n\n"
-    for uid in current_users:
-        stats = user_stats.get(uid, {})
-        username = user_stats.get("usernames", {}).get(uid, "Unknown")
+    for user in current_users:
+        uid = user["user_id"]
+        username = f"@{user['username']}" if user["username"] else "Unknown"
         
         # Получаем лимиты (проверка подписки для списка может быть медленной, 
         # поэтому показываем просто текущую активность за сегодня)
-        v_done = stats.get('video', 0)
-        a_done = stats.get('audio', 0)
+        v_done = user["video"]
+        a_done = user["audio"]
         
         text += f"• ID: `{uid}` ({username})\n  └ 🎬 {v_done} | 🎵 {a_done}\n\n"
 
     nav_buttons = []
     if page > 0:
-        nav_buttons.append(InlineKeyboardButton(text="⬅️ Пред.", callback_data=f"admin_users_{page-1}"))
-    if end < len(users):
-        nav_buttons.append(InlineKeyboardButton(text="След. ➡️", callback_data=f"admin_users_{page+1}"))
+        nav_buttons.append(InlineKeyboardButton(text="⬅️ Пред.", callback_data=f"admin_users_{page-1}_b{current_users[0]['seq']}"))
+    if has_next:
+        nav_buttons.append(InlineKeyboardButton(text="След. ➡️", callback_data=f"admin_users_{page+1}_a{current_users[-1]['seq']}"))
 
     kb = InlineKeyboardMarkup(inline_keyboard=[nav_buttons, [InlineKeyboardButton(text="⬅️ К статистике", callback_data="admin_stats")]])
     
@@ -193,7 +397,7 @@ async def list_users(callback: types.CallbackQuery):
 @dp.callback_query(F.data == "admin_broadcast")
 async def start_broadcast(callback: types.CallbackQuery):
     if callback.from_user.id != ADMIN_ID: return
-    broadcast_state[callback.from_user.id] = True
+    await state.set(broadcast_key(callback.from_user.id), True, ttl=3600)
     await callback.message.edit_text(
         "📢 **Создание рассылки**\n\n"
         "Отправь мне сообщение (текст, фото или видео), которое нужно разослать всем пользователям.\n"
@@ -204,31 +408,25 @@ async def start_broadcast(callback: types.CallbackQuery):
 @dp.callback_query(F.data == "admin_back")
 async def admin_back(callback: types.CallbackQuery):
     if callback.from_user.id != ADMIN_ID: return
-    broadcast_state.pop(callback.from_user.id, None)
+    await state.delete(broadcast_key(callback.from_user.id))
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="📊 Статистика", callback_data="admin_stats")],
+        [InlineKeyboardButton(text="📈 Метрики", callback_data="admin_metrics")],
+        [InlineKeyboardButton(text="🧰 Задачи", callback_data="admin_jobs")],
         [InlineKeyboardButton(text="📢 Рассылка", callback_data="admin_broadcast")]
     ])
     await callback.message.edit_text("🛠 **Панель администратора**", reply_markup=kb)
 
-@dp.message(F.text, lambda m: broadcast_state.get(m.from_user.id))
+async def is_broadcasting(message: types.Message):
+    return message.from_user.id == ADMIN_ID and bool(await state.get(broadcast_key(message.from_user.id)))
+
+@dp.message(F.text, is_broadcasting)
 async def perform_broadcast(message: types.Message):
     if message.from_user.id != ADMIN_ID: return
     
-    users = user_stats.get("all_users", [])
-    count = 0
-    await message.answer(f"🚀 Начинаю рассылку на {len(users)} пользователей...")
-    
-    for user_id in users:
-        try:
-            await bot.copy_message(chat_id=user_id, from_chat_id=message.chat.id, message_id=message.message_id)
-            count += 1
-            await asyncio.sleep(0.05) # Защита от спам-фильтра TG
-        except Exception as e:
-            logging.error(f"Failed to send message to {user_id}: {e}")
-    
-    broadcast_state.pop(message.from_user.id, None)
-    await message.answer(f"✅ Рассылка завершена! Получили: {count}/{len(users)}")
+    await state.delete(broadcast_key(message.from_user.id))
+    status = await message.answer(f"🚀 Начинаю рассылку на {stats_store.count_reachable()} пользователей...")
+    broadcaster.start(message.chat.id, message.chat.id, message.message_id, status.message_id)
 
 # --- END ADMIN PANEL ---
 
@@ -242,18 +440,20 @@ async def start_downloading(message: types.Message):
 @dp.message(F.text == "💎 Бонус и Лимиты")
 async def show_bonus(message: types.Message):
     user_id = str(message.from_user.id)
-    reset_daily_stats(user_id, message.from_user.username)
-    sub_count = await get_subs_count(user_id)
+    stats = reset_daily_stats(user_id, message.from_user.username)
+    # Пользователь мог только что подписаться — проверяем заново
+    subscriptions.invalidate(user_id)
+    sub_statuses = await subscriptions.get_statuses(user_id)
+    sub_count = sum(1 for subscribed in sub_statuses.values() if subscribed)
     limits = get_user_limits(user_id, sub_count)
-    stats = user_stats[user_id]
     
     status_text = ""
     for i, channel in enumerate(CHANNELS, 1):
-        try:
-            member = await bot.get_chat_member(chat_id=channel, user_id=user_id)
-            status = "✅ Подписан" if member.status not in ["left", "kicked"] else "❌ Не подписан"
-        except:
+        subscribed = sub_statuses.get(channel)
+        if subscribed is None:
             status = "❌ Ошибка"
+        else:
+            status = "✅ Подписан" if subscribed else "❌ Не подписан"
         status_text += f"{i}. {channel}: **{status}**\n"
 
     await message.answer(
@@ -275,11 +475,12 @@ async def show_bonus(message: types.Message):
 async def handle_url(message: types.Message):
     url = message.text
     user_id = str(message.from_user.id)
+    # Разбираем ссылку в фоне, пока пользователь выбирает формат (на frontend загрузчика нет)
+    probe_task = asyncio.create_task(downloader.probe(url)) if ROLE == "all" else None
     
-    reset_daily_stats(user_id, message.from_user.username)
+    stats = reset_daily_stats(user_id, message.from_user.username)
     sub_count = await get_subs_count(user_id)
     limits = get_user_limits(user_id, sub_count)
-    stats = user_stats[user_id]
 
     text = f"Что ты хочешь скачать?\n\n📊 Твои лимиты на сегодня:\n"
     text += f"🎬 Видео: {stats['video']}/{limits['video']}\n"
@@ -295,8 +496,24 @@ async def handle_url(message: types.Message):
         ]
     ])
     
-    pending_downloads[str(message.message_id)] = url
-    await message.answer(text, reply_markup=keyboard)
+    key = pending_key(message.chat.id, message.message_id)
+    await state.set(key, url, ttl=PENDING_TTL)
+    menu = await message.answer(text, reply_markup=keyboard)
+
+    if probe_task:
+        # Меню дополняем в фоне, чтобы обработчик (и остановка бота) не ждали конца разбора ссылки
+        task = asyncio.create_task(add_media_info(menu, probe_task, key, text, keyboard))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+async def add_media_info(menu, probe_task, key, text, keyboard):
+    info = await probe_task
+    # Дополняем меню, только если пользователь ещё не выбрал формат
+    if info and await state.get(key):
+        try:
+            await menu.edit_text(format_media_info(info) + "\n\n" + text, reply_markup=keyboard)
+        except TelegramBadRequest as e:
+            logging.warning(f"Failed to add media info to menu: {e}")
 
 @dp.callback_query(F.data.startswith("dl_"))
 async def process_download(callback: types.CallbackQuery):
@@ -305,59 +522,320 @@ async def process_download(callback: types.CallbackQuery):
     msg_id = data[2]
     user_id = str(callback.from_user.id)
     
-    url = pending_downloads.get(msg_id)
+    # Сразу забираем ссылку, чтобы повторное нажатие не запускало вторую загрузку
+    url = await state.pop(pending_key(callback.message.chat.id, msg_id))
     if not url:
         await callback.answer("Ошибка: ссылка устарела.")
         return
+    # Музыкальные площадки отдают только звук: лимит, линия, ключ кэша и способ отправки — как у аудио
+    if is_music_url(url):
+        mode = "audio"
 
-    reset_daily_stats(user_id, callback.from_user.username)
+    stats = reset_daily_stats(user_id, callback.from_user.username)
     sub_count = await get_subs_count(user_id)
     limits = get_user_limits(user_id, sub_count)
-    stats = user_stats[user_id]
 
     if stats[mode] >= limits[mode]:
         await callback.message.edit_text(f"❌ Лимит на сегодня исчерпан ({limits[mode]}/{limits[mode]}). Возвращайся завтра!")
         return
 
-    if download_semaphore._value == 0:
-        await callback.message.edit_text("⏳ Все линии загрузки заняты (10/10). Пожалуйста, подождите немного...")
+    # Если файл уже загружался в Telegram, отправляем его повторно по file_id
+    cache_key = downloader.media_key(url, mode)
+    cached_file_id = media_cache.get(cache_key) if cache_key else None
+    if cached_file_id:
+        try:
+            await send_media(callback.message.chat.id, mode, cached_file_id)
+            DOWNLOADS.inc(mode=mode, result="cache_hit")
+            stats_store.increment(user_id, mode)
+            await callback.message.delete()
+            return
+        except TelegramBadRequest as e:
+            logging.warning(f"Cached file_id for {cache_key} rejected: {e}")
+            media_cache.invalidate(cache_key)
+
+    job = {
+        "url": url,
+        "mode": mode,
+        "user_id": user_id,
+        "chat_id": callback.message.chat.id,
+        "status_message_id": callback.message.message_id,
+        "cache_key": cache_key,
+    }
+    if ROLE == "frontend":
+        # Задачи выполняют воркеры, поэтому незавершённые задачи пользователя считаем в общем состоянии
+        if await state.incr(active_jobs_key(user_id), ttl=ACTIVE_JOBS_TTL) > USER_JOB_LIMIT:
+            await release_active_job(user_id)
+            await reject_over_quota(callback, url, msg_id)
+            return
+        await state.push("jobs", job)
+        await callback.message.edit_text(f"⏳ Загрузка ({mode}) поставлена в очередь...")
+        return
 
-    async with download_semaphore:
-        await callback.message.edit_text(f"⏳ Начинаю загрузку ({mode})... Очередь: {10 - download_semaphore._value}/10")
-        
+    try:
+        result = await deliver(job)
+    except QuotaExceeded:
+        await reject_over_quota(callback, url, msg_id)
+        return
+    complete_job(job, result)
+
+async def reject_over_quota(callback, url, msg_id):
+    # Меню остаётся, пользователь сможет нажать кнопку позже
+    await state.set(pending_key(callback.message.chat.id, msg_id), url, ttl=PENDING_TTL)
+    await callback.answer(f"У тебя уже идёт {USER_JOB_LIMIT} загрузки. Дождись их окончания!", show_alert=True)
+
+async def release_active_job(user_id):
+    if await state.incr(active_jobs_key(user_id), -1, ttl=ACTIVE_JOBS_TTL) <= 0:
+        await state.delete(active_jobs_key(user_id))
+
+@dp.callback_query(F.data.startswith("cancel_"))
+async def cancel_download(callback: types.CallbackQuery):
+    # Загрузку ведёт deliver() (возможно, на другом воркере): он увидит флаг при следующей проверке
+    status_message_id = callback.data.split("_")[1]
+    await state.set(cancel_key(callback.message.chat.id, status_message_id), True, ttl=3600)
+    await callback.answer("Отменяю...")
+
+async def deliver(job):
+    """
+    Downloads the job's media and sends it to the user, keeping the status message up to date.
+    Runs in the "all" and "worker" roles. Returns {"ok": bool, "file_id": str | None}.
+    Raises QuotaExceeded if the user already has too many jobs.
+    """
+    url, mode, chat_id, status_message_id = job["url"], job["mode"], job["chat_id"], job["status_message_id"]
+    cancel_kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="❌ Отмена", callback_data=f"cancel_{status_message_id}")]
+    ])
+
+    async def set_status(text, reply_markup=None):
+        # Статус — только подсказка: если сообщение удалили или оно не изменилось, загрузка и её итог от этого не зависят
         try:
-            file_path = await downloader.download(url, mode=mode)
-            
-            if file_path and os.path.exists(file_path):
-                # На Zeabur иногда лучше проверять размер файла
-                if os.path.getsize(file_path) < 100:
-                    await callback.message.edit_text("❌ Ошибка: скачанный файл слишком мал или пуст. Возможно, защита YouTube заблокировала запрос.")
-                    os.remove(file_path)
-                    return
-
-                input_file = FSInputFile(file_path)
-                if mode == "video":
-                    await bot.send_video(callback.message.chat.id, video=input_file)
-                else:
-                    await bot.send_audio(callback.message.chat.id, audio=input_file)
-                
-                user_stats[user_id][mode] += 1
-                save_stats()
-                await callback.message.delete()
-                os.remove(file_path)
+            await bot.edit_message_text(text, chat_id=chat_id, message_id=status_message_id, reply_markup=reply_markup)
+        except TelegramBadRequest as e:
+            logging.warning(f"Failed to update download status: {e}")
+
+    job_key = job["cache_key"] or f"{url}:{mode}"
+    scheduled = download_scheduler.submit(
+        job["user_id"], job_key, mode,
+        lambda sj: downloader.download(url, mode=mode, on_progress=sj.set_progress),
+        cleanup=downloader.cleanup,
+    )
+    try:
+        # Пока задача в очереди или качается, показываем позицию или прогресс и проверяем, не нажата ли отмена
+        status_text = None
+        while True:
+            if await state.pop(cancel_key(chat_id, status_message_id)):
+                # Если файл ждут и другие пользователи, загрузка продолжится для них (см. release)
+                await set_status("❌ Загрузка отменена.")
+                return {"ok": False, "file_id": None}
+            position = download_scheduler.position(scheduled)
+            if position:
+                text = f"⏳ Ты в очереди ({mode}): {position}"
+            elif scheduled.progress:
+                text = f"⏬ Загрузка ({mode}): {format_progress(scheduled.progress)}"
             else:
-                await callback.message.edit_text("❌ Не удалось получить файл. YouTube/TikTok блокирует запросы с этого сервера. Попробуйте другую ссылку или позже.")
+                text = f"⏳ Начинаю загрузку ({mode})..."
+            if text != status_text:
+                await set_status(text, reply_markup=cancel_kb)
+                status_text = text
+            try:
+                file_path = await asyncio.wait_for(download_scheduler.wait(scheduled), timeout=PROGRESS_INTERVAL)
+                break
+            except asyncio.TimeoutError:
+                continue
+
+        
+        if file_path and os.path.exists(file_path):
+            # На Zeabur иногда лучше проверять размер файла
+            if os.path.getsize(file_path) < 100:
+                await set_status("❌ Ошибка: скачанный файл слишком мал или пуст. Возможно, защита YouTube заблокировала запрос.")
+                return {"ok": False, "file_id": None}
+            if os.path.getsize(file_path) > downloader.max_bytes:
+                raise TooLarge(os.path.getsize(file_path), downloader.max_bytes)
+
+            # Файл уже скачан — убираем кнопку отмены на время отправки
+            await set_status(f"📤 Отправляю ({mode})...")
+            sent = await send_media(chat_id, mode, FSInputFile(file_path))
+            try:
+                await bot.delete_message(chat_id, job["status_message_id"])
+            except TelegramBadRequest as e:
+                logging.warning(f"Failed to delete download status: {e}")
+            return {"ok": True, "file_id": extract_file_id(sent)}
+        else:
+            await set_status("❌ Не удалось получить файл. YouTube/TikTok блокирует запросы с этого сервера. Попробуйте другую ссылку или позже.")
+    except JobCancelled as e:
+        if e.args[0] == "admin":
+            await set_status("⛔ Загрузка остановлена администратором.")
+        else:
+            await set_status("⌛ Загрузка зависла и была остановлена. Попробуй ещё раз позже.")
+    except TooLarge as e:
+        await set_status(
+            f"❌ Файл слишком большой для Telegram: {format_size(e.size)} при лимите {e.limit // 1024 // 1024} МБ.\n"
+            + ("Попробуй скачать аудио или выбери видео покороче." if mode == "video" else "Попробуй трек покороче.")
+        )
+    except Exception as e:
+        logging.error(f"Error in process_download: {e}")
+        await set_status(f"⚠️ Ошибка сервера: {str(e)[:100]}. Мы уже разбираемся!")
+    finally:
+        download_scheduler.release(scheduled)
+    return {"ok": False, "file_id": None}
+
+def complete_job(job, result):
+    """Counts a delivered file towards the user's limit and remembers its file_id."""
+    if not result["ok"]:
+        return
+    stats_store.increment(job["user_id"], job["mode"])
+    if job["cache_key"] and result["file_id"]:
+        media_cache.put(job["cache_key"], result["file_id"])
+
+async def consume_results():
+    """Front-end role: applies results reported by download workers."""
+    while True:
+        try:
+            result = await state.pop_queue("results", timeout=5)
+            if result:
+                complete_job(result["job"], result)
+                await release_active_job(result["job"]["user_id"])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Failed to apply job result: {e}")
+            await asyncio.sleep(1)
+
+async def worker_loop(stopping):
+    """Worker role: takes download jobs from the shared queue and reports results back."""
+    while not stopping.is_set():
+        job = await state.pop_queue("jobs", timeout=5)
+        if not job:
+            continue
+        try:
+            result = await deliver(job)
+        except asyncio.CancelledError:
+            # Воркер останавливается: возвращаем задачу в очередь, её подхватит другой воркер
+            await state.push("jobs", job)
+            raise
         except Exception as e:
-            logging.error(f"Error in process_download: {e}")
-            await callback.message.edit_text(f"⚠️ Ошибка сервера: {str(e)[:100]}. Мы уже разбираемся!")
-        finally:
-            if msg_id in pending_downloads:
-                del pending_downloads[msg_id]
+            logging.error(f"Worker failed to deliver {job['url']}: {e}")
+            result = {"ok": False, "file_id": None}
+        await state.push("results", {"job": job, **result})
+
+# Обработчики, которые сейчас выполняются (нужны для корректной остановки)
+inflight_handlers = set()
+
+@dp.update.outer_middleware()
+async def track_inflight(handler, event, data):
+    task = asyncio.current_task()
+    inflight_handlers.add(task)
+    try:
+        return await handler(event, data)
+    finally:
+        inflight_handlers.discard(task)
+
+async def drain_handlers():
+    pending = inflight_handlers - {asyncio.current_task()}
+    if not pending:
+        return
+    logging.info(f"Waiting for {len(pending)} in-flight handlers to finish...")
+    done, pending = await asyncio.wait(pending, timeout=DRAIN_TIMEOUT)
+    if pending:
+        logging.warning(f"{len(pending)} handlers did not finish in {DRAIN_TIMEOUT}s")
+
+background_tasks = set()
+
+@dp.startup()
+async def on_startup():
+    stats_store.start()
+    broadcaster.resume()
+    logging.info(f"Accepting updates {time.monotonic() - STARTED_AT:.2f}s after start")
+    if ROLE == "all":
+        downloader.start()
+        # yt-dlp и процессы-воркеры прогреваем уже после того, как бот начал принимать обновления
+        background_tasks.add(asyncio.create_task(downloader.warm_up()))
+        background_tasks.add(asyncio.create_task(download_scheduler.watch(JOB_STALL_TIMEOUT)))
+    else:
+        background_tasks.add(asyncio.create_task(consume_results()))
+
+@dp.shutdown()
+async def on_shutdown():
+    await drain_handlers()
+    for task in background_tasks:
+        task.cancel()
+    await broadcaster.stop()
+    media_cache.flush()
+    await downloader.close()
+    await stats_store.close()
+    await state.close()
+
+async def health(request):
+    return web.json_response({"status": "ok", "role": ROLE, "mode": BOT_MODE, "inflight": len(inflight_handlers)})
+
+async def run_webhook():
+    if not WEBHOOK_URL:
+        raise ValueError("WEBHOOK_URL is not set in environment variables")
+
+    app = web.Application()
+    app.router.add_get("/healthz", health)
+    app.router.add_get("/metrics", metrics.handle_metrics)
+    # setup_application раньше обработчика: при остановке сначала дожидаемся хэндлеров, потом закрываем сессию бота
+    setup_application(app, dp, bot=bot)
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    # Накопившиеся обновления не сбрасываем — Telegram доставит их после перезапуска
+    await bot.set_webhook(f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET, drop_pending_updates=False)
+    logging.info(f"Webhook server listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+    await runner.cleanup()
+
+async def run_polling():
+    # Удаляем вебхук, но не накопившиеся сообщения: их обработаем после перезапуска.
+    # По SIGTERM aiogram прекращает опрос, а on_shutdown дожидается начатых загрузок
+    await bot.delete_webhook(drop_pending_updates=False)
+    await dp.start_polling(bot)
+
+async def run_worker():
+    downloader.start()
+    stopping = asyncio.Event()
+    tasks = [asyncio.create_task(worker_loop(stopping)) for _ in range(WORKER_CONCURRENCY)]
+    logging.info(f"Download worker started with {WORKER_CONCURRENCY} concurrent jobs "
+                 f"in {time.monotonic() - STARTED_AT:.2f}s")
+    warm_up = asyncio.create_task(downloader.warm_up())
+    watchdog = asyncio.create_task(download_scheduler.watch(JOB_STALL_TIMEOUT))
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stopping.set)
+    await stopping.wait()
+    # Новые задачи больше не берём, начатые загрузки даём доделать
+    logging.info(f"Stopping, waiting up to {DRAIN_TIMEOUT}s for running downloads...")
+    done, pending = await asyncio.wait(tasks, timeout=DRAIN_TIMEOUT)
+    if pending:
+        logging.warning(f"{len(pending)} downloads did not finish in {DRAIN_TIMEOUT}s, returning them to the queue")
+    for task in [*pending, warm_up, watchdog]:
+        task.cancel()
+    await asyncio.gather(*tasks, warm_up, watchdog, return_exceptions=True)
+    await downloader.close()
+    await state.close()
+    await bot.session.close()
 
 async def main():
-    # Удаляем вебхук и все накопившиеся сообщения, чтобы избежать конфликтов при перезапуске
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    metrics_runner = await metrics.start_server("0.0.0.0", METRICS_PORT) if METRICS_PORT else None
+    try:
+        if ROLE == "worker":
+            await run_worker()
+        elif BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            await run_polling()
+    finally:
+        if metrics_runner:
+            await metrics_runner.cleanup()
 
 if __name__ == "__main__":
     asyncio.run(main())
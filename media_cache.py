@@ -0,0 +1,94 @@
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class MediaCache:
+    """
+    Persistent cache of Telegram file_id values for media that was already uploaded.
+    Keys are "extractor:media_id:mode" strings (see Downloader.media_key). Entries expire after `ttl`
+    seconds and the least recently used ones are evicted above `max_entries`.
+    """
+
+    def __init__(self, path="media_cache.json", ttl=7 * 24 * 3600, max_entries=50000, save_interval=30):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.save_interval = save_interval
+        self._entries = OrderedDict()
+        self._dirty = False
+        self._last_save = 0.0
+        self._load()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry["ts"] > self.ttl:
+            del self._entries[key]
+            self._dirty = True
+            return None
+        self._entries.move_to_end(key)
+        return entry["file_id"]
+
+    def put(self, key, file_id):
+        self._entries[key] = {"file_id": file_id, "ts": time.time()}
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        self._dirty = True
+        self._maybe_save()
+
+    def invalidate(self, key):
+        if self._entries.pop(key, None) is not None:
+            self._dirty = True
+            self._maybe_save()
+
+    def flush(self):
+        if not self._dirty:
+            return
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(self._entries, f)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+            self._last_save = time.time()
+        except OSError as e:
+            logger.error(f"Failed to save media cache: {e}")
+
+    def _maybe_save(self):
+        # Кэш не критичен: пишем на диск не чаще раза в save_interval секунд
+        if time.time() - self._last_save >= self.save_interval:
+            self.flush()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to load media cache: {e}")
+            return
+        now = time.time()
+        for key, entry in sorted(data.items(), key=lambda item: item[1].get("ts", 0)):
+            if now - entry.get("ts", 0) <= self.ttl and entry.get("file_id"):
+                self._entries[key] = entry
+        self._last_save = now
+
+
+def extract_file_id(message):
+    """Returns the file_id of the media attached to a sent message."""
+    for attr in ("video", "audio", "document", "animation", "voice"):
+        media = getattr(message, attr, None)
+        if media is not None:
+            return media.file_id
+    return None
+
+
+media_cache = MediaCache()
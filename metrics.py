@@ -0,0 +1,210 @@
+import bisect
+import logging
+import math
+import time
+from contextlib import contextmanager
+
+from aiohttp import web
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+class Registry:
+    """Holds metrics and renders them in the Prometheus text format."""
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def on_collect(self, fn):
+        """`fn()` is called before every scrape, e.g. to refresh gauges."""
+        self.collectors.append(fn)
+        return fn
+
+    def collect(self):
+        for fn in self.collectors:
+            try:
+                fn()
+            except Exception as e:
+                logger.warning(f"Metrics collector {fn.__name__} failed: {e}")
+
+    def render(self):
+        self.collect()
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self._values = {}
+        registry.register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        for key, value in sorted(self._values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        super().__init__(name, help, labels, registry)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            # [счётчики по корзинам (не накопительные), сумма, количество]
+            state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels):
+        state = self._values.get(self._key(labels))
+        return state[2] if state else 0
+
+    def quantile(self, q, **labels):
+        """Estimates the q-quantile from the buckets (like histogram_quantile in PromQL)."""
+        state = self._values.get(self._key(labels))
+        if not state or not state[2]:
+            return None
+        rank = q * state[2]
+        cumulative = 0
+        for i, n in enumerate(state[0]):
+            if cumulative + n >= rank and n:
+                upper = self.buckets[i]
+                lower = self.buckets[i - 1] if i else 0.0
+                if upper == math.inf:
+                    return lower
+                return lower + (upper - lower) * (rank - cumulative) / n
+            cumulative += n
+        return self.buckets[-2]
+
+    def samples(self):
+        for key, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                labels = _format_labels(self.labelnames, key, ("le", _format_value(bound)))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {count}"
+
+
+# --- Метрики бота ---
+
+STAGE_SECONDS = Histogram(
+    "gld_stage_seconds",
+    "Duration of download pipeline stages: queue_wait, subscription_check, probe, extract, download, postprocess, upload",
+    ["stage"],
+)
+DOWNLOADS = Counter("gld_downloads_total", "Download requests by mode and result", ["mode", "result"])
+BYTES = Counter("gld_bytes_total", "Bytes downloaded from media sites and uploaded to Telegram", ["direction"])
+TELEGRAM_SENDS = Counter("gld_telegram_sends_total", "Media sends to Telegram by method and result", ["method", "result"])
+BROADCAST_MESSAGES = Counter("gld_broadcast_messages_total", "Broadcast deliveries by result", ["result"])
+STORE_COMMIT_SECONDS = Histogram(
+    "gld_store_commit_seconds", "Duration of stats store commits",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+STORE_WRITES = Counter("gld_store_writes_total", "Stats store row writes by kind", ["kind"])
+SLOTS_BUSY = Gauge("gld_slots_busy", "Download slots in use", ["mode"])
+SLOTS_TOTAL = Gauge("gld_slots_total", "Download slots configured", ["mode"])
+QUEUE_DEPTH = Gauge("gld_queue_depth", "Jobs waiting for a download slot", ["mode"])
+WORKERS_BUSY = Gauge("gld_workers_busy", "Worker processes running a job")
+PROCESS_CPU = Gauge("gld_process_cpu_seconds", "CPU time used by the bot process")
+PROCESS_MAX_RSS = Gauge("gld_process_max_rss_bytes", "Peak resident memory of the bot process")
+
+
+@REGISTRY.on_collect
+def _collect_process():
+    PROCESS_CPU.set(time.process_time())
+    if resource is not None:
+        # ru_maxrss в Linux — в килобайтах
+        PROCESS_MAX_RSS.set(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+
+
+async def handle_metrics(request):
+    return web.Response(text=REGISTRY.render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_server(host, port):
+    """Starts a standalone /metrics endpoint; returns the AppRunner to clean up on shutdown."""
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Metrics endpoint listening on {host}:{port}/metrics")
+    return runner
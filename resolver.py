@@ -0,0 +1,197 @@
+import asyncio
+import html
+import logging
+import re
+import sqlite3
+import time
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+
+_SPOTIFY_TRACK = re.compile(r'(?:open\.spotify\.com/(?:intl-[\w-]+/)?track/|spotify:track:)([A-Za-z0-9]{22})')
+_YANDEX_TRACK = re.compile(r'(?:music\.yandex\.[a-z]+|yandex\.[a-z]+/music)/(?:album/\d+/)?track/(\d+)')
+_META_TAG = re.compile(r'<meta\s[^>]*>', re.IGNORECASE)
+_ATTR = re.compile(r'([\w:-]+)\s*=\s*"([^"]*)"')
+_TITLE = re.compile(r'<title[^>]*>(.*?)</title>', re.IGNORECASE | re.DOTALL)
+
+
+def normalize_track_url(url):
+    """
+    Returns a canonical track key ("spotify:<id>" / "yandex:<id>") and the page URL to read
+    metadata from, or (None, None) if the URL is not a single track.
+    Tracking parameters, locale prefixes and album paths don't change the key.
+    """
+    m = _SPOTIFY_TRACK.search(url)
+    if m:
+        return f"spotify:{m.group(1)}", f"https://open.spotify.com/track/{m.group(1)}"
+    m = _YANDEX_TRACK.search(url)
+    if m:
+        return f"yandex:{m.group(1)}", f"https://music.yandex.ru/track/{m.group(1)}"
+    return None, None
+
+
+def _meta(page):
+    meta = {}
+    for tag in _META_TAG.findall(page):
+        attrs = {name.lower(): value for name, value in _ATTR.findall(tag)}
+        name = attrs.get('property') or attrs.get('name')
+        if name and 'content' in attrs:
+            meta[name.lower()] = html.unescape(attrs['content']).strip()
+    return meta
+
+
+def parse_spotify(page):
+    """og:title is the track, og:description is "Artist · Album · Song · 2021"."""
+    meta = _meta(page)
+    title = meta.get('og:title')
+    if not title:
+        return None
+    artist = meta.get('music:musician_description')
+    if not artist and meta.get('og:description'):
+        description = re.sub(r'^Listen to .*? on Spotify\.\s*', '', meta['og:description'])
+        artist = description.split(' · ')[0].strip()
+    return {'artist': artist or None, 'title': title}
+
+
+def parse_yandex(page):
+    """The page title is "Title — Artist. Слушать онлайн на Яндекс Музыке"; og:title is a fallback."""
+    m = _TITLE.search(page)
+    if m:
+        text = html.unescape(m.group(1)).strip()
+        parts = re.match(r'(.+?) — (.+?)\.\s+Слушать', text)
+        if parts:
+            return {'artist': parts.group(2), 'title': parts.group(1)}
+    meta = _meta(page)
+    if meta.get('og:title'):
+        return {'artist': None, 'title': meta['og:title']}
+    return None
+
+
+PARSERS = {
+    'spotify': parse_spotify,
+    'yandex': parse_yandex,
+}
+
+
+async def fetch_page(url, timeout=10):
+    async with aiohttp.ClientSession(headers={'User-Agent': USER_AGENT}) as session:
+        async with session.get(url, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            response.raise_for_status()
+            return await response.text()
+
+
+class ResolverCache:
+    """Persistent track key -> YouTube video id mapping with TTL (SQLite)."""
+
+    def __init__(self, path="resolver_cache.db", ttl=30 * 24 * 3600):
+        self.ttl = ttl
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS tracks (
+                track_key TEXT PRIMARY KEY,
+                video_id TEXT NOT NULL,
+                query TEXT,
+                resolved_at REAL NOT NULL
+            )
+        """)
+        self.conn.commit()
+
+    def get(self, track_key):
+        row = self.conn.execute(
+            "SELECT video_id FROM tracks WHERE track_key = ? AND resolved_at > ?", (track_key, time.time() - self.ttl)
+        ).fetchone()
+        return row[0] if row else None
+
+    def put(self, track_key, video_id, query):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO tracks (track_key, video_id, query, resolved_at) VALUES (?, ?, ?, ?)",
+            (track_key, video_id, query, time.time()),
+        )
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+class TrackResolver:
+    """
+    Maps Spotify / Yandex Music track links to a YouTube video.
+    The link is normalized to a track key, artist and title are read from the page
+    metadata, one targeted search is run, and the result is cached persistently,
+    so repeated requests for the same track skip the page fetch and the search.
+
+    A track that couldn't be resolved is not retried for `failure_ttl` seconds
+    (the probe and the download of one link would otherwise both fetch and search).
+
+    `fetch(url) -> html`, `parsers` ({platform: parse(html) -> {'artist', 'title'}})
+    and `search(query) -> video id` are pluggable, e.g. to run against stored pages offline.
+    """
+
+    def __init__(self, cache, search, fetch=fetch_page, parsers=None, failure_ttl=300):
+        self.cache = cache
+        self.search = search
+        self.fetch = fetch
+        self.parsers = parsers or PARSERS
+        self.failure_ttl = failure_ttl
+        self._inflight = {}
+        # track_key -> время неудачной попытки
+        self._failures = {}
+
+    def cached(self, url):
+        """Video id of an already resolved track, without network access."""
+        track_key, _ = normalize_track_url(url)
+        return self.cache.get(track_key) if track_key else None
+
+    async def resolve(self, url):
+        """Returns the YouTube watch URL for the track, or None if it can't be resolved."""
+        track_key, page_url = normalize_track_url(url)
+        if not track_key:
+            return None
+        video_id = self.cache.get(track_key)
+        failed_at = self._failures.get(track_key)
+        if video_id is None and failed_at is not None and time.monotonic() - failed_at < self.failure_ttl:
+            return None
+        if video_id is None:
+            task = self._inflight.get(track_key)
+            if task is None:
+                task = asyncio.ensure_future(self._resolve(track_key, page_url))
+                self._inflight[track_key] = task
+                task.add_done_callback(lambda t: self._inflight.pop(track_key, None))
+            video_id = await asyncio.shield(task)
+        return f"https://www.youtube.com/watch?v={video_id}" if video_id else None
+
+    async def _resolve(self, track_key, page_url):
+        video_id = await self._lookup(track_key, page_url)
+        if video_id:
+            self._failures.pop(track_key, None)
+        else:
+            now = time.monotonic()
+            self._failures = {key: t for key, t in self._failures.items() if now - t < self.failure_ttl}
+            self._failures[track_key] = now
+        return video_id
+
+    async def _lookup(self, track_key, page_url):
+        platform = track_key.split(':', 1)[0]
+        try:
+            track = self.parsers[platform](await self.fetch(page_url))
+        except Exception as e:
+            logger.warning(f"Failed to read track metadata from {page_url}: {e}")
+            return None
+        if not track or not track.get('title'):
+            logger.warning(f"No track metadata found on {page_url}")
+            return None
+
+        query = f"{track['artist']} - {track['title']}" if track.get('artist') else track['title']
+        try:
+            video_id = await self.search(query)
+        except Exception as e:
+            logger.warning(f"Search failed for {query!r}: {e}")
+            return None
+        if video_id:
+            logger.info(f"Resolved {track_key} ({query}) to YouTube video {video_id}")
+            self.cache.put(track_key, video_id, query)
+        return video_id
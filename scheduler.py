@@ -0,0 +1,258 @@
+import asyncio
+import functools
+import itertools
+import logging
+import time
+from collections import deque
+
+from metrics import STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class JobCancelled(Exception):
+    """The job was stopped before it finished; the argument is the reason (abandoned, stalled, admin)."""
+
+
+_job_ids = itertools.count(1)
+
+
+class Job:
+    def __init__(self, key, user_id, mode, run, cleanup=None):
+        self.id = next(_job_ids)
+        self.key = key
+        self.user_id = user_id
+        self.mode = mode
+        self.run = run
+        self.cleanup = cleanup
+        self.future = asyncio.get_running_loop().create_future()
+        self.waiters = 1
+        self.started = False
+        self.queued_at = time.monotonic()
+        self.started_at = None
+        self.task = None
+        # Последний отчёт о ходе выполнения (его публикует run) и время его получения.
+        # Пока отчётов нет, задача с занятым слотом ещё ждёт свободный процесс-воркер
+        self.progress = None
+        self.progress_at = None
+        self.cancel_reason = None
+
+    def set_progress(self, progress):
+        self.progress = progress
+        self.progress_at = time.monotonic()
+
+
+class _Lane:
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self.running = 0
+        # user_id -> число запущенных задач пользователя в этой линии
+        self.user_running = {}
+        # user_id -> номер последнего обслуживания (для round-robin)
+        self.served = {}
+        self._ticket = 0
+        # user_id -> deque[Job]
+        self.queues = {}
+
+    @staticmethod
+    def _next_user(queues, running, served):
+        # Первым идёт пользователь с наименьшим числом запущенных задач,
+        # при равенстве — тот, кого дольше всех не обслуживали
+        return min(queues, key=lambda user_id: (running.get(user_id, 0), served.get(user_id, 0)))
+
+    def order(self):
+        """Queued jobs in the order they will be started."""
+        queues = {user_id: deque(q) for user_id, q in self.queues.items()}
+        running = dict(self.user_running)
+        served = dict(self.served)
+        ticket = self._ticket
+        result = []
+        while queues:
+            user_id = self._next_user(queues, running, served)
+            result.append(queues[user_id].popleft())
+            running[user_id] = running.get(user_id, 0) + 1
+            ticket += 1
+            served[user_id] = ticket
+            if not queues[user_id]:
+                del queues[user_id]
+        return result
+
+    def pop_next(self):
+        user_id = self._next_user(self.queues, self.user_running, self.served)
+        job = self.queues[user_id].popleft()
+        if not self.queues[user_id]:
+            del self.queues[user_id]
+        self._ticket += 1
+        self.served[user_id] = self._ticket
+        return job
+
+    def forget(self, user_id):
+        if user_id not in self.queues and user_id not in self.user_running:
+            self.served.pop(user_id, None)
+
+
+class DownloadScheduler:
+    """
+    Download job scheduler.
+    Jobs run in separate lanes per mode (audio/video) with their own concurrency,
+    users are served round-robin inside a lane, each user may have at most
+    `per_user_limit` unfinished jobs (None for no limit), and identical in-flight jobs (same key)
+    are coalesced so all requesters share one result.
+    A job that every requester has released before it finished is cancelled,
+    which frees its slot (and kills its worker process) right away.
+    """
+
+    def __init__(self, lanes, per_user_limit=2):
+        self.lanes = {mode: _Lane(concurrency) for mode, concurrency in lanes.items()}
+        self.per_user_limit = per_user_limit
+        self._inflight = {}
+        self._user_jobs = {}
+
+    def submit(self, user_id, key, mode, run, cleanup=None):
+        """
+        Queues `run(job)` (a coroutine function; it may report progress with job.set_progress)
+        or joins an identical in-flight job.
+        `cleanup(result)` is called once the last requester has released the job.
+        """
+        job = self._inflight.get(key)
+        if job is not None:
+            job.waiters += 1
+            return job
+        if self.per_user_limit and self._user_jobs.get(user_id, 0) >= self.per_user_limit:
+            raise QuotaExceeded()
+
+        job = Job(key, user_id, mode, run, cleanup)
+        self._inflight[key] = job
+        self._user_jobs[user_id] = self._user_jobs.get(user_id, 0) + 1
+        lane = self.lanes[mode]
+        lane.queues.setdefault(user_id, deque()).append(job)
+        self._pump(lane)
+        return job
+
+    def position(self, job):
+        """
+        1-based place in line, 0 once the job has reported progress (i.e. is really running) or finished.
+        Lane slots may outnumber worker processes, so a started job that hasn't reported
+        progress yet is still waiting for a process; such jobs (of all lanes) go first,
+        in the order they got their slots, followed by the job's own lane queue.
+        """
+        # Задачу могли отменить, пока её ждал deliver(): в очереди её уже нет
+        if job.progress is not None or job.future.done():
+            return 0
+        waiting = sorted(
+            (j for j in self._inflight.values() if j.started and j.progress is None and not j.future.done()),
+            key=lambda j: j.started_at,
+        )
+        if job.started:
+            return waiting.index(job) + 1
+        return len(waiting) + self.lanes[job.mode].order().index(job) + 1
+
+    async def wait(self, job):
+        """Returns the job's result; raises JobCancelled if it was stopped."""
+        return await asyncio.shield(job.future)
+
+    def release(self, job):
+        job.waiters -= 1
+        if job.waiters <= 0 and not job.future.done():
+            self.cancel(job, "abandoned")
+        self._maybe_cleanup(job)
+
+    def cancel(self, job, reason):
+        """Stops a queued or running job; its requesters get JobCancelled(reason)."""
+        if job.future.done():
+            return
+        if job.started:
+            job.cancel_reason = reason
+            job.task.cancel()
+            return
+        lane = self.lanes[job.mode]
+        queue = lane.queues[job.user_id]
+        queue.remove(job)
+        if not queue:
+            del lane.queues[job.user_id]
+            lane.forget(job.user_id)
+        self._forget(job)
+        job.future.set_exception(JobCancelled(reason))
+
+    def jobs(self):
+        """Unfinished jobs: running ones first, then queued ones in lane order."""
+        running = [job for job in self._inflight.values() if job.started]
+        queued = [job for lane in self.lanes.values() for job in lane.order()]
+        return running + queued
+
+    async def watch(self, stall_timeout, interval=30):
+        """
+        Cancels running jobs that haven't reported progress for `stall_timeout` seconds.
+        The clock starts with the first report, which `run` sends once a worker process has
+        picked the job up: waiting for a free process is queueing, not a stall.
+        FFmpeg doesn't report progress, so post-processing ({'stage': 'postprocess'})
+        is left to the downloader's own job timeout.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            for job in self.jobs():
+                if job.progress is None or job.progress.get('stage') == 'postprocess':
+                    continue
+                if now - job.progress_at > stall_timeout:
+                    logger.warning(f"Job {job.key} made no progress for {int(now - job.progress_at)}s, cancelling it")
+                    self.cancel(job, "stalled")
+
+    def stats(self):
+        return {
+            mode: {"running": lane.running, "queued": sum(len(q) for q in lane.queues.values()), "slots": lane.concurrency}
+            for mode, lane in self.lanes.items()
+        }
+
+    def _pump(self, lane):
+        while lane.running < lane.concurrency and lane.queues:
+            job = lane.pop_next()
+            job.started = True
+            job.started_at = time.monotonic()
+            STAGE_SECONDS.observe(job.started_at - job.queued_at, stage="queue_wait")
+            lane.running += 1
+            lane.user_running[job.user_id] = lane.user_running.get(job.user_id, 0) + 1
+            job.task = asyncio.create_task(job.run(job))
+            job.task.add_done_callback(functools.partial(self._finish, lane, job))
+
+    def _finish(self, lane, job, task):
+        # Колбэк, а не try/finally в корутине: задача может быть отменена ещё до первого шага
+        if task.cancelled():
+            if job.cancel_reason is None:
+                job.future.cancel()
+            else:
+                logger.info(f"Job {job.key} cancelled ({job.cancel_reason})")
+                job.future.set_exception(JobCancelled(job.cancel_reason))
+        elif task.exception() is not None:
+            job.future.set_exception(task.exception())
+        else:
+            job.future.set_result(task.result())
+
+        lane.running -= 1
+        lane.user_running[job.user_id] -= 1
+        if not lane.user_running[job.user_id]:
+            del lane.user_running[job.user_id]
+            lane.forget(job.user_id)
+        self._forget(job)
+        self._pump(lane)
+        self._maybe_cleanup(job)
+
+    def _forget(self, job):
+        if self._inflight.get(job.key) is job:
+            del self._inflight[job.key]
+        self._user_jobs[job.user_id] -= 1
+        if not self._user_jobs[job.user_id]:
+            del self._user_jobs[job.user_id]
+
+    def _maybe_cleanup(self, job):
+        if job.waiters > 0 or not job.future.done() or job.future.cancelled():
+            return
+        if job.future.exception() is None and job.cleanup:
+            try:
+                job.cleanup(job.future.result())
+            except Exception as e:
+                logger.error(f"Cleanup failed for job {job.key}: {e}")
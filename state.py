@@ -0,0 +1,239 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class StateBackend:
+    """
+    Shared state used by the front-end and worker roles:
+    a key-value store with TTL and named FIFO queues. Values must be JSON-serializable.
+    """
+
+    async def get(self, key):
+        raise NotImplementedError
+
+    async def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    async def pop(self, key):
+        """Atomically returns and deletes the value."""
+        raise NotImplementedError
+
+    async def delete(self, key):
+        raise NotImplementedError
+
+    async def incr(self, key, amount=1, ttl=None):
+        """Atomically adds `amount` to an integer value (missing counts as 0) and returns the result."""
+        raise NotImplementedError
+
+    async def push(self, queue, value):
+        raise NotImplementedError
+
+    async def pop_queue(self, queue, timeout):
+        """Waits up to `timeout` seconds for an item; returns None if there was none."""
+        raise NotImplementedError
+
+    async def queue_size(self, queue):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class MemoryBackend(StateBackend):
+    """Single-process backend; only usable when the front-end and workers run in one process."""
+
+    def __init__(self):
+        self._data = {}
+        self._queues = {}
+
+    def _queue(self, name):
+        if name not in self._queues:
+            self._queues[name] = asyncio.Queue()
+        return self._queues[name]
+
+    async def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires and expires < time.time():
+            del self._data[key]
+            return None
+        return value
+
+    async def set(self, key, value, ttl=None):
+        self._data[key] = (value, time.time() + ttl if ttl else None)
+
+    async def pop(self, key):
+        value = await self.get(key)
+        self._data.pop(key, None)
+        return value
+
+    async def delete(self, key):
+        self._data.pop(key, None)
+
+    async def incr(self, key, amount=1, ttl=None):
+        value = (await self.get(key) or 0) + amount
+        await self.set(key, value, ttl=ttl)
+        return value
+
+    async def push(self, queue, value):
+        self._queue(queue).put_nowait(value)
+
+    async def pop_queue(self, queue, timeout):
+        try:
+            return await asyncio.wait_for(self._queue(queue).get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def queue_size(self, queue):
+        return self._queue(queue).qsize()
+
+
+class SQLiteBackend(StateBackend):
+    """
+    Backend in a shared SQLite file (WAL), for running the roles
+    as separate processes on one host without Redis.
+    """
+
+    def __init__(self, path, poll_interval=0.5):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.conn = sqlite3.connect(path, isolation_level=None, timeout=10)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS kv (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expires REAL
+            );
+            CREATE TABLE IF NOT EXISTS queue (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                value TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_queue_name ON queue (name, id);
+        """)
+
+    async def get(self, key):
+        row = self.conn.execute(
+            "SELECT value FROM kv WHERE key = ? AND (expires IS NULL OR expires > ?)", (key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    async def set(self, key, value, ttl=None):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)",
+            (key, json.dumps(value), time.time() + ttl if ttl else None),
+        )
+
+    async def pop(self, key):
+        row = self.conn.execute(
+            "DELETE FROM kv WHERE key = ? RETURNING value, expires", (key,)
+        ).fetchone()
+        if not row or (row[1] and row[1] < time.time()):
+            return None
+        return json.loads(row[0])
+
+    async def delete(self, key):
+        self.conn.execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    async def incr(self, key, amount=1, ttl=None):
+        now = time.time()
+        row = self.conn.execute(
+            """
+            INSERT INTO kv (key, value, expires) VALUES (?, ?, ?)
+            ON CONFLICT (key) DO UPDATE SET
+                value = CAST(CASE WHEN expires IS NOT NULL AND expires <= ? THEN 0 ELSE CAST(value AS INTEGER) END
+                             + ? AS TEXT),
+                expires = excluded.expires
+            RETURNING value
+            """,
+            (key, json.dumps(amount), now + ttl if ttl else None, now, amount),
+        ).fetchone()
+        return json.loads(row[0])
+
+    async def push(self, queue, value):
+        self.conn.execute("INSERT INTO queue (name, value) VALUES (?, ?)", (queue, json.dumps(value)))
+
+    async def pop_queue(self, queue, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            row = self.conn.execute(
+                "DELETE FROM queue WHERE id = (SELECT id FROM queue WHERE name = ? ORDER BY id LIMIT 1) RETURNING value",
+                (queue,),
+            ).fetchone()
+            if row:
+                return json.loads(row[0])
+            if time.monotonic() >= deadline:
+                return None
+            await asyncio.sleep(self.poll_interval)
+
+    async def queue_size(self, queue):
+        return self.conn.execute("SELECT COUNT(*) FROM queue WHERE name = ?", (queue,)).fetchone()[0]
+
+    async def close(self):
+        self.conn.close()
+
+
+class RedisBackend(StateBackend):
+    """Backend on a Redis-compatible server (requires the `redis` package)."""
+
+    def __init__(self, url, prefix="gld:"):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("STATE_URL points to Redis, but the 'redis' package is not installed")
+        self.redis = redis.from_url(url)
+        self.prefix = prefix
+
+    async def get(self, key):
+        value = await self.redis.get(self.prefix + key)
+        return json.loads(value) if value is not None else None
+
+    async def set(self, key, value, ttl=None):
+        await self.redis.set(self.prefix + key, json.dumps(value), ex=ttl)
+
+    async def pop(self, key):
+        value = await self.redis.getdel(self.prefix + key)
+        return json.loads(value) if value is not None else None
+
+    async def delete(self, key):
+        await self.redis.delete(self.prefix + key)
+
+    async def incr(self, key, amount=1, ttl=None):
+        async with self.redis.pipeline() as pipe:
+            pipe.incrby(self.prefix + key, amount)
+            if ttl:
+                pipe.expire(self.prefix + key, ttl)
+            value, *_ = await pipe.execute()
+        return value
+
+    async def push(self, queue, value):
+        await self.redis.lpush(self.prefix + "q:" + queue, json.dumps(value))
+
+    async def pop_queue(self, queue, timeout):
+        item = await self.redis.brpop(self.prefix + "q:" + queue, timeout=max(1, int(timeout)))
+        return json.loads(item[1]) if item else None
+
+    async def queue_size(self, queue):
+        return await self.redis.llen(self.prefix + "q:" + queue)
+
+    async def close(self):
+        await self.redis.aclose()
+
+
+def create_backend(url):
+    """memory:// (default), sqlite:///path/to/state.db or redis://host:port/db"""
+    if not url or url.startswith("memory://"):
+        return MemoryBackend()
+    if url.startswith("sqlite:///"):
+        return SQLiteBackend(url[len("sqlite:///"):])
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBackend(url)
+    raise ValueError(f"Unsupported STATE_URL: {url}")
@@ -0,0 +1,273 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+
+from metrics import STORE_COMMIT_SECONDS, STORE_WRITES
+
+logger = logging.getLogger(__name__)
+
+MODES = ("video", "audio")
+
+
+class StatsStore:
+    """
+    SQLite (WAL) storage of per-user daily counters.
+    Every change is a single-row update; commits are batched and done
+    by a background task every `commit_interval` seconds or after `commit_every` writes.
+
+    All users are also kept in an in-memory dict index, so per-message lookups
+    and the total/daily-active counters don't touch the database or scan the user base.
+    """
+
+    def __init__(self, path="user_stats.db", json_path="user_stats.json", commit_interval=1.0, commit_every=200):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.commit_every = commit_every
+        self._pending = 0
+        self._flush_task = None
+        self.conn = sqlite3.connect(path, isolation_level="DEFERRED")
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._create_schema()
+        self._migrate_json(json_path)
+        # user_id -> [video, audio, last_reset, username, blocked]
+        self._users = {}
+        self._active_day = None
+        self._active_count = 0
+        self._load_index()
+
+    def _create_schema(self):
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS users (
+                user_id TEXT PRIMARY KEY,
+                username TEXT,
+                video INTEGER NOT NULL DEFAULT 0,
+                audio INTEGER NOT NULL DEFAULT 0,
+                last_reset TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_users_last_reset ON users (last_reset);
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                admin_chat_id INTEGER NOT NULL,
+                from_chat_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                status_message_id INTEGER,
+                total INTEGER NOT NULL DEFAULT 0,
+                cursor INTEGER NOT NULL DEFAULT 0,
+                sent INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                blocked INTEGER NOT NULL DEFAULT 0,
+                done INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        """)
+        columns = [row["name"] for row in self.conn.execute("PRAGMA table_info(users)")]
+        if "blocked" not in columns:
+            self.conn.execute("ALTER TABLE users ADD COLUMN blocked INTEGER NOT NULL DEFAULT 0")
+        self.conn.commit()
+
+    def _migrate_json(self, json_path):
+        """
+        One-time import of the legacy user_stats.json. The file is left in place
+        (it is tracked in the repository); the meta flag keeps it from being imported twice.
+        """
+        if not json_path or not os.path.exists(json_path):
+            return
+        if self.conn.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone():
+            return
+        try:
+            with open(json_path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to read {json_path} for migration: {e}")
+            return
+
+        usernames = data.get("usernames", {})
+        # Сохраняем порядок регистрации из all_users, затем добавляем тех, кого там нет
+        user_ids = list(dict.fromkeys(data.get("all_users", [])))
+        user_ids += [k for k, v in data.items() if k not in ("all_users", "usernames") and isinstance(v, dict) and k not in user_ids]
+
+        rows = []
+        for uid in user_ids:
+            stats = data.get(uid) if isinstance(data.get(uid), dict) else {}
+            username = usernames.get(uid)
+            rows.append((
+                uid,
+                username.lstrip("@") if username else None,
+                stats.get("video", 0),
+                stats.get("audio", 0),
+                stats.get("last_reset"),
+            ))
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO users (user_id, username, video, audio, last_reset) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_migrated', ?)", (json_path,))
+        logger.info(f"Migrated {len(rows)} users from {json_path} to {self.path}")
+
+    def _load_index(self):
+        for row in self.conn.execute("SELECT user_id, video, audio, last_reset, username, blocked FROM users"):
+            self._users[row["user_id"]] = [row["video"], row["audio"], row["last_reset"], row["username"], row["blocked"]]
+
+    def _active_for(self, today):
+        # При смене дня пересчитываем счётчик один раз по индексу last_reset
+        if self._active_day != today:
+            self._active_day = today
+            self._active_count = self.conn.execute(
+                "SELECT COUNT(*) FROM users WHERE last_reset = ?", (today,)
+            ).fetchone()[0]
+
+    def touch_user(self, user_id, username, today):
+        """
+        Registers the user if needed, updates the username and resets
+        the daily counters on the first visit of the day. Returns the user's stats.
+        """
+        user_id = str(user_id)
+        self._active_for(today)
+        user = self._users.get(user_id)
+        if user is None:
+            self._users[user_id] = [0, 0, today, username, 0]
+            self._active_count += 1
+            self.conn.execute(
+                "INSERT INTO users (user_id, username, video, audio, last_reset) VALUES (?, ?, 0, 0, ?)",
+                (user_id, username, today),
+            )
+            self._mark_dirty("new_user")
+            return {"video": 0, "audio": 0, "last_reset": today}
+
+        if username and user[3] != username:
+            user[3] = username
+            self.conn.execute("UPDATE users SET username = ? WHERE user_id = ?", (username, user_id))
+            self._mark_dirty("username")
+        if user[4]:
+            # Пользователь снова пишет боту — значит, разблокировал его
+            user[4] = 0
+            self.conn.execute("UPDATE users SET blocked = 0 WHERE user_id = ?", (user_id,))
+            self._mark_dirty("unblock")
+        if user[2] != today:
+            user[0], user[1], user[2] = 0, 0, today
+            self._active_count += 1
+            self.conn.execute(
+                "UPDATE users SET video = 0, audio = 0, last_reset = ? WHERE user_id = ?", (today, user_id)
+            )
+            self._mark_dirty("daily_reset")
+        return {"video": user[0], "audio": user[1], "last_reset": user[2]}
+
+    def get_user(self, user_id):
+        user = self._users.get(str(user_id))
+        if user is None:
+            return None
+        return {"video": user[0], "audio": user[1], "last_reset": user[2], "username": user[3]}
+
+    def increment(self, user_id, mode):
+        if mode not in MODES:
+            raise ValueError(f"Unknown mode: {mode}")
+        user = self._users.get(str(user_id))
+        if user is not None:
+            user[MODES.index(mode)] += 1
+        self.conn.execute(f"UPDATE users SET {mode} = {mode} + 1 WHERE user_id = ?", (str(user_id),))
+        self._mark_dirty("increment")
+
+    def count_users(self):
+        return len(self._users)
+
+    def count_active(self, today):
+        self._active_for(today)
+        return self._active_count
+
+    def list_users(self, limit, after=None, before=None):
+        """
+        Keyset pagination in registration order.
+        Returns users with seq greater than `after` (or less than `before`), ascending.
+        """
+        query = "SELECT rowid AS seq, user_id, username, video, audio FROM users"
+        if before is not None:
+            rows = self.conn.execute(f"{query} WHERE rowid < ? ORDER BY rowid DESC LIMIT ?", (before, limit)).fetchall()
+            rows.reverse()
+        else:
+            rows = self.conn.execute(f"{query} WHERE rowid > ? ORDER BY rowid LIMIT ?", (after or 0, limit)).fetchall()
+        return [dict(row) for row in rows]
+
+    def mark_blocked(self, user_id):
+        user = self._users.get(str(user_id))
+        if user is not None:
+            user[4] = 1
+        self.conn.execute("UPDATE users SET blocked = 1 WHERE user_id = ?", (str(user_id),))
+        self._mark_dirty("blocked")
+
+    def count_reachable(self):
+        return sum(1 for user in self._users.values() if not user[4])
+
+    def broadcast_recipients(self, after, limit):
+        """Returns (seq, user_id) of users that haven't blocked the bot, in registration order."""
+        return self.conn.execute(
+            "SELECT rowid, user_id FROM users WHERE rowid > ? AND blocked = 0 ORDER BY rowid LIMIT ?", (after, limit)
+        ).fetchall()
+
+    def create_broadcast(self, admin_chat_id, from_chat_id, message_id, status_message_id, total):
+        cur = self.conn.execute(
+            "INSERT INTO broadcasts (admin_chat_id, from_chat_id, message_id, status_message_id, total) VALUES (?, ?, ?, ?, ?)",
+            (admin_chat_id, from_chat_id, message_id, status_message_id, total),
+        )
+        self.conn.commit()
+        return cur.lastrowid
+
+    def get_broadcast(self, broadcast_id):
+        row = self.conn.execute("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,)).fetchone()
+        return dict(row) if row else None
+
+    def unfinished_broadcasts(self):
+        return [row[0] for row in self.conn.execute("SELECT id FROM broadcasts WHERE done = 0 ORDER BY id")]
+
+    def checkpoint_broadcast(self, broadcast_id, cursor, sent, failed, blocked, done=False):
+        """Saves broadcast progress and commits it together with pending writes."""
+        self.conn.execute(
+            "UPDATE broadcasts SET cursor = ?, sent = ?, failed = ?, blocked = ?, done = ? WHERE id = ?",
+            (cursor, sent, failed, blocked, int(done), broadcast_id),
+        )
+        self.conn.commit()
+        self._pending = 0
+
+    def _mark_dirty(self, kind):
+        STORE_WRITES.inc(kind=kind)
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        if self._pending:
+            with STORE_COMMIT_SECONDS.time():
+                self.conn.commit()
+            self._pending = 0
+
+    async def run_flusher(self):
+        """Background task that commits batched writes."""
+        try:
+            while True:
+                await asyncio.sleep(self.commit_interval)
+                self.commit()
+        except asyncio.CancelledError:
+            self.commit()
+            raise
+
+    def start(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self.run_flusher())
+
+    async def close(self):
+        if self._flush_task:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        self.commit()
+        self.conn.close()
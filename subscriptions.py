@@ -0,0 +1,72 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class SubscriptionChecker:
+    """
+    Checks channel subscriptions for a user.
+    All channels are queried concurrently, results are cached per user for `ttl`
+    seconds and concurrent checks for the same user share a single request.
+    """
+
+    def __init__(self, bot, channels, ttl=60, max_entries=10000):
+        self.bot = bot
+        self.channels = channels
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._cache = OrderedDict()
+        self._inflight = {}
+
+    async def get_statuses(self, user_id):
+        """
+        Returns {channel: True/False/None} for the user,
+        where None means the status could not be checked.
+        """
+        key = str(user_id)
+        cached = self._cache.get(key)
+        if cached and time.monotonic() - cached[0] < self.ttl:
+            return cached[1]
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(key))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._on_done(key, t))
+        # shield: отмена одного обработчика не должна отменять общий запрос
+        return await asyncio.shield(task)
+
+    async def get_count(self, user_id):
+        statuses = await self.get_statuses(user_id)
+        return sum(1 for subscribed in statuses.values() if subscribed)
+
+    def invalidate(self, user_id):
+        self._cache.pop(str(user_id), None)
+
+    async def _fetch(self, user_id):
+        results = await asyncio.gather(*(self._check(channel, user_id) for channel in self.channels))
+        return dict(zip(self.channels, results))
+
+    async def _check(self, channel, user_id):
+        try:
+            member = await self.bot.get_chat_member(chat_id=channel, user_id=int(user_id))
+            return member.status not in ["left", "kicked"]
+        except Exception as e:
+            logger.error(f"Error checking sub for {channel}: {e}")
+            return None
+
+    def _on_done(self, key, task):
+        self._inflight.pop(key, None)
+        if task.cancelled() or task.exception() is not None:
+            return
+        statuses = task.result()
+        # Ошибки проверки не кэшируем, чтобы не лишать пользователя бонуса надолго
+        if None in statuses.values():
+            return
+        self._cache[key] = (time.monotonic(), statuses)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
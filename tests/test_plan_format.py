@@ -0,0 +1,63 @@
+import pytest
+
+import downloader
+from downloader import TooLarge, estimate_size, plan_format
+
+MB = 1024 * 1024
+
+
+def fmt(format_id, vcodec="none", acodec="none", ext="mp4", size=None, **fields):
+    return {"format_id": format_id, "vcodec": vcodec, "acodec": acodec, "ext": ext, "filesize": size, **fields}
+
+
+# Как у YouTube: раздельные потоки видео и звука плюс один совмещённый
+YOUTUBE_FORMATS = [
+    fmt("140", acodec="mp4a.40.2", ext="m4a", size=3 * MB, abr=128),
+    fmt("251", acodec="opus", ext="webm", size=4 * MB, abr=160),
+    fmt("18", vcodec="avc1.42001E", acodec="mp4a.40.2", size=20 * MB, height=360),
+    fmt("134", vcodec="avc1.4d401e", size=10 * MB, height=360),
+    fmt("137", vcodec="avc1.640028", size=45 * MB, height=1080),
+    fmt("248", vcodec="vp9", ext="webm", size=40 * MB, height=1080),
+]
+
+
+def test_audio_prefers_m4a():
+    assert plan_format({"formats": YOUTUBE_FORMATS}, "audio", 50 * MB) == "140"
+
+
+def test_video_best_pair_that_fits():
+    # H.264 важнее разрешения: берётся самое высокое H.264-видео, которое вместе со звуком влезает в лимит
+    assert plan_format({"formats": YOUTUBE_FORMATS}, "video", 50 * MB) == "137+140"
+    assert plan_format({"formats": YOUTUBE_FORMATS}, "video", 30 * MB) == "134+140"
+
+
+def test_video_too_large():
+    formats = [f for f in YOUTUBE_FORMATS if f["format_id"] != "18"]
+    with pytest.raises(TooLarge) as e:
+        plan_format({"formats": formats}, "video", 5 * MB)
+    assert e.value.size == 13 * MB
+
+
+def test_unknown_sizes_fall_back_to_default_selection():
+    formats = [fmt("22", vcodec="avc1", acodec="mp4a"), fmt("140", acodec="mp4a", ext="m4a")]
+    assert plan_format({"formats": formats}, "video", 50 * MB) is None
+    assert plan_format({"formats": []}, "audio", 50 * MB) is None
+
+
+def test_audio_from_muxed_video_checks_the_audio_size():
+    # Нет отдельной звуковой дорожки: звук извлекается из видео, которое само больше лимита
+    info = {"duration": 600, "formats": [fmt("hd", vcodec="avc1", acodec="mp4a", size=200 * MB, abr=128)]}
+    assert plan_format(info, "audio", 50 * MB) is None
+    assert estimate_size(info, "audio") == 128 * 1000 / 8 * 600
+
+    info["duration"] = 4 * 3600
+    with pytest.raises(TooLarge):
+        plan_format(info, "audio", 50 * MB)
+
+
+def test_size_guard_skips_muxed_video_in_audio_mode(monkeypatch):
+    monkeypatch.setattr(downloader, "_job_state", {"mode": "audio", "budget": 50 * MB, "bytes": {}, "expected": {}})
+    progress = {"status": "downloading", "filename": "a.mp4", "downloaded_bytes": MB, "total_bytes": 200 * MB}
+    downloader._size_guard({**progress, "info_dict": {"vcodec": "avc1", "acodec": "mp4a"}})
+    with pytest.raises(downloader._SizeLimitExceeded):
+        downloader._size_guard({**progress, "info_dict": {"vcodec": "none", "acodec": "mp4a"}})
@@ -0,0 +1,161 @@
+import asyncio
+
+import pytest
+
+import resolver
+from conftest import read_fixture
+from resolver import ResolverCache, TrackResolver, normalize_track_url, parse_spotify, parse_yandex
+
+SPOTIFY_ID = "7tFiyTwD0nx5a1eklYtX2J"
+
+
+@pytest.mark.parametrize("url", [
+    f"https://open.spotify.com/track/{SPOTIFY_ID}",
+    f"https://open.spotify.com/track/{SPOTIFY_ID}?si=1a2b3c4d5e6f",
+    f"https://open.spotify.com/intl-de/track/{SPOTIFY_ID}?si=x&utm_source=copy-link",
+    f"spotify:track:{SPOTIFY_ID}",
+])
+def test_normalize_spotify(url):
+    assert normalize_track_url(url) == (f"spotify:{SPOTIFY_ID}", f"https://open.spotify.com/track/{SPOTIFY_ID}")
+
+
+@pytest.mark.parametrize("url", [
+    "https://music.yandex.ru/album/3466/track/28823",
+    "https://music.yandex.ru/album/3466/track/28823?utm_medium=copy_link",
+    "https://music.yandex.com/track/28823",
+    "https://yandex.ru/music/album/3466/track/28823",
+])
+def test_normalize_yandex(url):
+    assert normalize_track_url(url) == ("yandex:28823", "https://music.yandex.ru/track/28823")
+
+
+@pytest.mark.parametrize("url", [
+    "https://open.spotify.com/album/1GbtB4zTqAsyfZEsm1RZfx",
+    "https://open.spotify.com/playlist/37i9dQZF1DXcBWIGoYBM5M",
+    "https://music.yandex.ru/album/3466",
+    "https://www.youtube.com/watch?v=fJ9rUzIMcZQ",
+])
+def test_normalize_not_a_track(url):
+    assert normalize_track_url(url) == (None, None)
+
+
+def test_parse_spotify():
+    assert parse_spotify(read_fixture("spotify_track.html")) == {
+        "artist": "Queen", "title": "Bohemian Rhapsody - Remastered 2011",
+    }
+
+
+def test_parse_spotify_artist_from_description():
+    assert parse_spotify(read_fixture("spotify_track_no_musician.html")) == {
+        "artist": "Queen", "title": "Don't Stop Me Now",
+    }
+
+
+def test_parse_yandex():
+    assert parse_yandex(read_fixture("yandex_track.html")) == {"artist": "Кино", "title": "Группа крови"}
+
+
+def test_parse_yandex_og_title_fallback():
+    assert parse_yandex(read_fixture("yandex_track_og_only.html")) == {"artist": None, "title": "Rock & Roll"}
+
+
+def test_parsers_without_metadata():
+    page = "<html><head><title>Spotify – Web Player</title></head></html>"
+    assert parse_spotify(page) is None
+    assert parse_yandex(page) is None
+
+
+def test_cache_ttl(tmp_path, monkeypatch):
+    cache = ResolverCache(str(tmp_path / "resolver.db"), ttl=3600)
+    now = 1_700_000_000.0
+    monkeypatch.setattr(resolver.time, "time", lambda: now)
+    cache.put("spotify:x", "fJ9rUzIMcZQ", "Queen - Bohemian Rhapsody")
+    assert cache.get("spotify:x") == "fJ9rUzIMcZQ"
+
+    now += 3599
+    assert cache.get("spotify:x") == "fJ9rUzIMcZQ"
+    now += 2
+    assert cache.get("spotify:x") is None
+    cache.close()
+
+
+def test_cache_persists(tmp_path):
+    path = str(tmp_path / "resolver.db")
+    cache = ResolverCache(path)
+    cache.put("yandex:28823", "abc", "Кино - Группа крови")
+    cache.close()
+
+    cache = ResolverCache(path)
+    assert cache.get("yandex:28823") == "abc"
+    cache.close()
+
+
+class FakeSite:
+    """Serves fixture pages and answers searches; counts calls."""
+
+    def __init__(self, pages, results):
+        self.pages = pages
+        self.results = results
+        self.fetches = []
+        self.queries = []
+
+    async def fetch(self, url):
+        self.fetches.append(url)
+        await asyncio.sleep(0.01)
+        return self.pages[url]
+
+    async def search(self, query):
+        self.queries.append(query)
+        return self.results.get(query)
+
+
+def make_resolver(tmp_path, site, **kwargs):
+    return TrackResolver(ResolverCache(str(tmp_path / "resolver.db")), search=site.search, fetch=site.fetch, **kwargs)
+
+
+def test_resolve_and_cache(tmp_path):
+    site = FakeSite(
+        {f"https://open.spotify.com/track/{SPOTIFY_ID}": read_fixture("spotify_track.html")},
+        {"Queen - Bohemian Rhapsody - Remastered 2011": "fJ9rUzIMcZQ"},
+    )
+    track_resolver = make_resolver(tmp_path, site)
+    url = f"https://open.spotify.com/track/{SPOTIFY_ID}?si=abc"
+
+    async def run():
+        # Одновременные запросы одного трека делят одно разрешение
+        results = await asyncio.gather(track_resolver.resolve(url), track_resolver.resolve(url))
+        again = await track_resolver.resolve(f"spotify:track:{SPOTIFY_ID}")
+        return results, again
+
+    results, again = asyncio.run(run())
+    assert results == ["https://www.youtube.com/watch?v=fJ9rUzIMcZQ"] * 2
+    assert again == results[0]
+    assert len(site.fetches) == 1
+    assert site.queries == ["Queen - Bohemian Rhapsody - Remastered 2011"]
+    assert track_resolver.cached(url) == "fJ9rUzIMcZQ"
+
+
+def test_resolve_without_metadata(tmp_path):
+    site = FakeSite({"https://music.yandex.ru/track/1": "<html></html>"}, {})
+    track_resolver = make_resolver(tmp_path, site)
+    assert asyncio.run(track_resolver.resolve("https://music.yandex.ru/album/2/track/1")) is None
+    assert site.queries == []
+    assert track_resolver.cached("https://music.yandex.ru/album/2/track/1") is None
+
+
+def test_failure_not_retried_until_ttl(tmp_path):
+    url = "https://music.yandex.ru/album/3466/track/28823"
+    site = FakeSite({"https://music.yandex.ru/track/28823": read_fixture("yandex_track.html")}, {})
+    track_resolver = make_resolver(tmp_path, site)
+
+    async def run():
+        return [await track_resolver.resolve(url) for _ in range(3)]
+
+    assert asyncio.run(run()) == [None] * 3
+    assert site.queries == ["Кино - Группа крови"]
+
+    # После failure_ttl трек ищется снова
+    track_resolver.failure_ttl = 0
+    site.results["Кино - Группа крови"] = "abc"
+    assert asyncio.run(track_resolver.resolve(url)) == "https://www.youtube.com/watch?v=abc"
+    assert len(site.queries) == 2
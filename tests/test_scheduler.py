@@ -0,0 +1,185 @@
+import asyncio
+
+import pytest
+
+from scheduler import DownloadScheduler, JobCancelled, QuotaExceeded
+
+
+class FakeDownloads:
+    """Job bodies that run until the test finishes them; records the start order."""
+
+    def __init__(self):
+        self.started = []
+        self.gates = {}
+
+    def run(self, key):
+        async def run(job):
+            self.started.append(key)
+            await self.gates.setdefault(key, asyncio.Event()).wait()
+            return f"downloads/{key}"
+        return run
+
+    async def finish(self, scheduler, job):
+        self.gates.setdefault(job.key, asyncio.Event()).set()
+        result = await scheduler.wait(job)
+        # Следующая задача линии запускается на следующем шаге цикла
+        await asyncio.sleep(0)
+        return result
+
+    async def finish_all(self, scheduler):
+        while scheduler.jobs():
+            await self.finish(scheduler, scheduler.jobs()[0])
+
+
+def test_round_robin_between_users():
+    async def run():
+        scheduler = DownloadScheduler({"video": 1}, per_user_limit=None)
+        downloads = FakeDownloads()
+        jobs = {}
+        for user_id, key in [("a", "a1"), ("a", "a2"), ("a", "a3"), ("b", "b1"), ("b", "b2")]:
+            jobs[key] = scheduler.submit(user_id, key, "video", downloads.run(key))
+        await asyncio.sleep(0)
+        order = [job.key for job in scheduler.jobs()]
+        for key in order:
+            await downloads.finish(scheduler, jobs[key])
+        return order, downloads.started
+
+    order, started = asyncio.run(run())
+    assert order == ["a1", "b1", "a2", "b2", "a3"]
+    assert started == order
+
+
+def test_quota_exceeded():
+    async def run():
+        scheduler = DownloadScheduler({"video": 1, "audio": 1}, per_user_limit=2)
+        downloads = FakeDownloads()
+        first = scheduler.submit("a", "v1", "video", downloads.run("v1"))
+        scheduler.submit("a", "a1", "audio", downloads.run("a1"))
+        with pytest.raises(QuotaExceeded):
+            scheduler.submit("a", "v2", "video", downloads.run("v2"))
+        # Присоединиться к уже идущей задаче можно и сверх лимита, другие пользователи не ограничены
+        assert scheduler.submit("a", "v1", "video", downloads.run("v1")) is first
+        scheduler.submit("b", "v2", "video", downloads.run("v2"))
+
+        await downloads.finish(scheduler, first)
+        scheduler.submit("a", "v3", "video", downloads.run("v3"))
+        await downloads.finish_all(scheduler)
+
+    asyncio.run(run())
+
+
+def test_coalescing_and_cleanup():
+    cleaned = []
+
+    async def run():
+        scheduler = DownloadScheduler({"video": 2})
+        downloads = FakeDownloads()
+        job = scheduler.submit("a", "same", "video", downloads.run("same"), cleanup=cleaned.append)
+        assert scheduler.submit("b", "same", "video", downloads.run("same"), cleanup=cleaned.append) is job
+        assert job.waiters == 2
+        await asyncio.sleep(0)
+
+        assert await downloads.finish(scheduler, job) == "downloads/same"
+        assert await scheduler.wait(job) == "downloads/same"
+        scheduler.release(job)
+        assert cleaned == []
+        scheduler.release(job)
+        assert cleaned == ["downloads/same"]
+        assert downloads.started == ["same"]
+
+        # Завершённая задача больше не объединяется с новыми запросами
+        assert scheduler.submit("a", "same", "video", downloads.run("same")) is not job
+        await downloads.finish_all(scheduler)
+
+    asyncio.run(run())
+
+
+def test_cancel_queued_job():
+    cleaned = []
+
+    async def run():
+        scheduler = DownloadScheduler({"video": 1})
+        downloads = FakeDownloads()
+        running = scheduler.submit("a", "v1", "video", downloads.run("v1"))
+        queued = scheduler.submit("b", "v2", "video", downloads.run("v2"), cleanup=cleaned.append)
+        await asyncio.sleep(0)
+
+        scheduler.release(queued)
+        with pytest.raises(JobCancelled) as e:
+            await scheduler.wait(queued)
+        assert e.value.args[0] == "abandoned"
+        assert scheduler.stats()["video"] == {"running": 1, "queued": 0, "slots": 1}
+
+        await downloads.finish(scheduler, running)
+        assert downloads.started == ["v1"]
+        assert scheduler.stats()["video"]["running"] == 0
+        # Квота пользователя освобождена
+        scheduler.submit("b", "v3", "video", downloads.run("v3"))
+        scheduler.submit("b", "v4", "video", downloads.run("v4"))
+        await downloads.finish_all(scheduler)
+
+    asyncio.run(run())
+    assert cleaned == []
+
+
+def test_cancel_running_job_frees_slot():
+    async def run():
+        scheduler = DownloadScheduler({"video": 1})
+        downloads = FakeDownloads()
+        running = scheduler.submit("a", "v1", "video", downloads.run("v1"))
+        queued = scheduler.submit("b", "v2", "video", downloads.run("v2"))
+        await asyncio.sleep(0)
+
+        scheduler.cancel(running, "admin")
+        with pytest.raises(JobCancelled) as e:
+            await scheduler.wait(running)
+        assert e.value.args[0] == "admin"
+        await asyncio.sleep(0)
+        assert downloads.started == ["v1", "v2"]
+        assert scheduler.stats()["video"]["running"] == 1
+        await downloads.finish(scheduler, queued)
+
+    asyncio.run(run())
+
+
+def test_cancel_before_first_step():
+    async def run():
+        scheduler = DownloadScheduler({"video": 1})
+        downloads = FakeDownloads()
+        job = scheduler.submit("a", "v1", "video", downloads.run("v1"))
+        # Задача создана, но ещё ни разу не выполнялась
+        scheduler.release(job)
+        with pytest.raises(JobCancelled):
+            await scheduler.wait(job)
+        assert downloads.started == []
+        assert scheduler.stats()["video"]["running"] == 0
+        assert scheduler.jobs() == []
+
+    asyncio.run(run())
+
+
+def test_position_counts_jobs_waiting_for_a_process():
+    async def run():
+        scheduler = DownloadScheduler({"video": 2, "audio": 1}, per_user_limit=None)
+        downloads = FakeDownloads()
+        v1 = scheduler.submit("a", "v1", "video", downloads.run("v1"))
+        v2 = scheduler.submit("b", "v2", "video", downloads.run("v2"))
+        a1 = scheduler.submit("c", "a1", "audio", downloads.run("a1"))
+        v3 = scheduler.submit("d", "v3", "video", downloads.run("v3"))
+        await asyncio.sleep(0)
+
+        # Слоты заняты, но ни одна задача ещё не получила процесс
+        positions = [scheduler.position(job) for job in (v1, v2, a1, v3)]
+        v1.set_progress({"stage": "download", "downloaded": 0})
+        after_progress = [scheduler.position(job) for job in (v1, v2, a1, v3)]
+
+        await downloads.finish(scheduler, v2)
+        after_finish = [scheduler.position(job) for job in (v1, v2, a1, v3)]
+        await downloads.finish_all(scheduler)
+        return positions, after_progress, after_finish
+
+    positions, after_progress, after_finish = asyncio.run(run())
+    assert positions == [1, 2, 3, 4]
+    assert after_progress == [0, 1, 2, 3]
+    # v3 получил слот v2 и ждёт процесс после a1
+    assert after_finish == [0, 0, 1, 2]
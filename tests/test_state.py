@@ -0,0 +1,151 @@
+import asyncio
+import os
+import uuid
+
+import pytest
+
+from state import MemoryBackend, RedisBackend, SQLiteBackend, create_backend
+
+REDIS_URL = os.getenv("TEST_REDIS_URL", "redis://localhost:6379/15")
+
+
+def _redis_available():
+    try:
+        import redis
+    except ImportError:
+        return False
+    try:
+        redis.Redis.from_url(REDIS_URL, socket_connect_timeout=0.5).ping()
+    except redis.RedisError:
+        return False
+    return True
+
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def make_backend(request, tmp_path):
+    """Returns a factory: backends must be created inside the event loop that uses them."""
+    if request.param == "memory":
+        return MemoryBackend
+    if request.param == "sqlite":
+        return lambda: SQLiteBackend(str(tmp_path / "state.db"), poll_interval=0.05)
+    if not _redis_available():
+        pytest.skip(f"no Redis server at {REDIS_URL}")
+    # Свой префикс на тест, чтобы не мешать другим данным в базе
+    prefix = f"gld-test:{uuid.uuid4().hex}:"
+    return lambda: RedisBackend(REDIS_URL, prefix=prefix)
+
+
+def run(make_backend, body):
+    async def main():
+        backend = make_backend()
+        try:
+            return await body(backend)
+        finally:
+            await backend.close()
+    return asyncio.run(main())
+
+
+def test_get_set(make_backend):
+    async def body(state):
+        assert await state.get("missing") is None
+        await state.set("job", {"url": "https://example.com", "mode": "video"})
+        assert await state.get("job") == {"url": "https://example.com", "mode": "video"}
+        await state.set("job", True)
+        assert await state.get("job") is True
+        await state.delete("job")
+        assert await state.get("job") is None
+    run(make_backend, body)
+
+
+def test_ttl(make_backend):
+    async def body(state):
+        await state.set("short", "v", ttl=1)
+        await state.set("long", "v", ttl=60)
+        assert await state.get("short") == "v"
+        await asyncio.sleep(1.2)
+        assert await state.get("short") is None
+        assert await state.pop("short") is None
+        assert await state.get("long") == "v"
+    run(make_backend, body)
+
+
+def test_incr(make_backend):
+    async def body(state):
+        assert await state.incr("jobs:1") == 1
+        assert await state.incr("jobs:1", ttl=60) == 2
+        assert await state.incr("jobs:1", -1) == 1
+        assert await state.get("jobs:1") == 1
+        results = await asyncio.gather(*(state.incr("jobs:2") for _ in range(5)))
+        assert sorted(results) == [1, 2, 3, 4, 5]
+        # Истёкший счётчик начинается заново
+        await state.set("jobs:3", 7, ttl=1)
+        await asyncio.sleep(1.2)
+        assert await state.incr("jobs:3") == 1
+    run(make_backend, body)
+
+
+def test_pop_returns_once(make_backend):
+    async def body(state):
+        await state.set("pending", "https://example.com", ttl=60)
+        results = await asyncio.gather(*(state.pop("pending") for _ in range(5)))
+        assert results.count("https://example.com") == 1
+        assert await state.get("pending") is None
+        assert await state.pop("pending") is None
+    run(make_backend, body)
+
+
+def test_queue_fifo(make_backend):
+    async def body(state):
+        for i in range(5):
+            await state.push("jobs", {"n": i})
+        await state.push("results", "other queue")
+        assert await state.queue_size("jobs") == 5
+        assert [await state.pop_queue("jobs", timeout=1) for _ in range(5)] == [{"n": i} for i in range(5)]
+        assert await state.queue_size("jobs") == 0
+        assert await state.pop_queue("results", timeout=1) == "other queue"
+    run(make_backend, body)
+
+
+def test_pop_queue_timeout(make_backend):
+    async def body(state):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        assert await state.pop_queue("empty", timeout=1) is None
+        assert loop.time() - started >= 0.9
+    run(make_backend, body)
+
+
+def test_pop_queue_waits_for_push(make_backend):
+    async def body(state):
+        async def push_later():
+            await asyncio.sleep(0.2)
+            await state.push("jobs", "late")
+        pusher = asyncio.create_task(push_later())
+        assert await state.pop_queue("jobs", timeout=3) == "late"
+        await pusher
+    run(make_backend, body)
+
+
+def test_sqlite_shared_between_connections(tmp_path):
+    path = str(tmp_path / "state.db")
+
+    async def body():
+        frontend, worker = SQLiteBackend(path, poll_interval=0.05), SQLiteBackend(path, poll_interval=0.05)
+        await frontend.push("jobs", {"n": 1})
+        await frontend.set("cancel:1:2", True, ttl=60)
+        assert await worker.pop_queue("jobs", timeout=1) == {"n": 1}
+        assert await worker.pop("cancel:1:2") is True
+        assert await frontend.get("cancel:1:2") is None
+        await frontend.close()
+        await worker.close()
+    asyncio.run(body())
+
+
+def test_create_backend(tmp_path):
+    assert isinstance(create_backend(None), MemoryBackend)
+    assert isinstance(create_backend("memory://"), MemoryBackend)
+    backend = create_backend(f"sqlite:///{tmp_path / 'state.db'}")
+    assert isinstance(backend, SQLiteBackend)
+    asyncio.run(backend.close())
+    with pytest.raises(ValueError):
+        create_backend("postgres://localhost/state")
@@ -0,0 +1,231 @@
+import asyncio
+import logging
+import os
+import pickle
+import signal
+import struct
+import sys
+import threading
+
+logger = logging.getLogger(__name__)
+
+_HEADER = struct.Struct("!I")
+_PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# В процессе-воркере — функция, отправляющая отчёт о ходе задачи основному процессу
+_progress = None
+
+
+def report_progress(data):
+    """Sends `data` to the on_progress callback of the running job; a no-op outside a worker."""
+    if _progress is not None:
+        _progress(data)
+
+
+def available_cpus():
+    """
+    CPUs this process may actually use: the affinity mask (cpusets) capped by the
+    cgroup v2 CPU quota (`docker run --cpus`). os.cpu_count() reports the whole host.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # macOS, Windows
+        cpus = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, -(-int(quota) // int(period))))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+class JobTimeout(Exception):
+    pass
+
+
+class JobFailed(Exception):
+    """The job raised an exception inside the worker process."""
+
+
+class WorkerCrashed(Exception):
+    pass
+
+
+class _Worker:
+    def __init__(self, proc):
+        self.proc = proc
+        self.jobs = 0
+
+    async def send(self, obj):
+        data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        self.proc.stdin.write(_HEADER.pack(len(data)) + data)
+        await self.proc.stdin.drain()
+
+    async def recv(self):
+        header = await self.proc.stdout.readexactly(_HEADER.size)
+        data = await self.proc.stdout.readexactly(_HEADER.unpack(header)[0])
+        return pickle.loads(data)
+
+
+class WorkerPool:
+    """
+    Bounded pool of long-lived worker processes (`python -m workers`).
+    Jobs are module-level functions executed in a worker; each worker is recycled
+    after `max_jobs_per_worker` jobs. A job that times out or is cancelled
+    kills its worker, so the slot is freed immediately and a fresh one is spawned.
+    Every worker leads its own process group, and killing it kills the whole group,
+    including the FFmpeg processes yt-dlp started.
+    Workers are started lazily on first use; the default size is available_cpus().
+    A job may call report_progress() any number of times before it returns;
+    every report is passed to the `on_progress` callback given to run().
+    `on_start()` is called once a worker has been assigned, so callers can tell
+    a job that waits for a free process from one that is running.
+    """
+
+    def __init__(self, size=None, max_jobs_per_worker=50):
+        self.size = size or available_cpus()
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self._idle = None
+        self._busy = set()
+        self._waiting = 0
+
+    async def run(self, fn, *args, timeout=None, on_progress=None, on_start=None, **kwargs):
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+            for _ in range(self.size):
+                self._idle.put_nowait(None)
+
+        self._waiting += 1
+        try:
+            worker = await self._idle.get()
+        finally:
+            self._waiting -= 1
+        try:
+            if on_start is not None:
+                on_start()
+            if worker is None or worker.proc.returncode is not None:
+                worker = await self._spawn()
+            self._busy.add(worker)
+            worker.jobs += 1
+            await worker.send((fn, args, kwargs))
+            return await asyncio.wait_for(self._wait_result(worker, on_progress), timeout)
+        except asyncio.TimeoutError:
+            await self._kill(worker)
+            worker = None
+            raise JobTimeout(f"{fn.__name__} did not finish in {timeout}s")
+        except asyncio.CancelledError:
+            await self._kill(worker)
+            worker = None
+            raise
+        except (asyncio.IncompleteReadError, BrokenPipeError, ConnectionResetError) as e:
+            await self._kill(worker)
+            worker = None
+            raise WorkerCrashed(f"Worker died while running {fn.__name__}: {e!r}")
+        finally:
+            if worker is not None:
+                self._busy.discard(worker)
+                if worker.jobs >= self.max_jobs_per_worker:
+                    await self._retire(worker)
+                    worker = None
+            self._idle.put_nowait(worker)
+
+    def stats(self):
+        return {"size": self.size, "busy": len(self._busy), "waiting": self._waiting}
+
+    async def shutdown(self):
+        if self._idle is None:
+            return
+        for worker in list(self._busy):
+            await self._kill(worker)
+        while not self._idle.empty():
+            worker = self._idle.get_nowait()
+            if worker is not None:
+                await self._retire(worker)
+        self._idle = None
+
+    async def _wait_result(self, worker, on_progress):
+        while True:
+            status, payload = await worker.recv()
+            if status == "progress":
+                if on_progress is not None:
+                    on_progress(payload)
+                continue
+            if status == "error":
+                raise JobFailed(payload)
+            return payload
+
+    async def _spawn(self):
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(filter(None, [_PACKAGE_DIR, env.get("PYTHONPATH")]))
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, "-m", "workers",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            env=env,
+            # Своя группа процессов: при убийстве воркера убиваем и запущенный им FFmpeg
+            start_new_session=hasattr(os, "killpg"),
+        )
+        logger.info(f"Started download worker pid={proc.pid}")
+        return _Worker(proc)
+
+    async def _retire(self, worker):
+        try:
+            await worker.send(None)
+            await asyncio.wait_for(worker.proc.wait(), timeout=5)
+        except (asyncio.TimeoutError, BrokenPipeError, ConnectionResetError):
+            await self._kill(worker)
+
+    async def _kill(self, worker):
+        if worker is None:
+            return
+        self._busy.discard(worker)
+        if hasattr(os, "killpg"):
+            # Группу убиваем, даже если сам воркер уже умер: его FFmpeg мог остаться
+            try:
+                os.killpg(worker.proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        if worker.proc.returncode is None:
+            worker.proc.kill()
+            await worker.proc.wait()
+            logger.warning(f"Killed download worker pid={worker.proc.pid}")
+
+
+def serve():
+    """Worker process loop: reads jobs from stdin and writes results to stdout."""
+    out = os.fdopen(os.dup(1), "wb")
+    # Всё, что библиотеки пишут в stdout, уходит в stderr и не ломает протокол
+    os.dup2(2, 1)
+    inp = sys.stdin.buffer
+    # yt-dlp вызывает хуки и из потоков загрузки фрагментов
+    lock = threading.Lock()
+
+    def send(obj):
+        data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        with lock:
+            out.write(_HEADER.pack(len(data)) + data)
+            out.flush()
+
+    global _progress
+    _progress = lambda data: send(("progress", data))
+
+    while True:
+        header = inp.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            return
+        job = pickle.loads(inp.read(_HEADER.unpack(header)[0]))
+        if job is None:
+            return
+        fn, args, kwargs = job
+        try:
+            send(("ok", fn(*args, **kwargs)))
+        except Exception as e:
+            send(("error", f"{type(e).__name__}: {e}"))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    from workers import serve as _serve
+    _serve()